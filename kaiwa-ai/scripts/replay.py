@@ -0,0 +1,181 @@
+"""
+記録した/speechセッションをサーバーに対して再生し、ターンごとのレイテンシを計測する
+
+    # 記録を4倍速で再生してレポートを保存
+    python scripts/replay.py run src/recordings/sessions.jsonl --url ws://localhost:8000 --speed 4 --output before.json
+    # 2つのビルドのレポートを比較
+    python scripts/replay.py compare before.json after.json
+
+LLM/TTSは scripts/stub_backends.py で置き換えておくと、外部APIやGPUなしで再現性のある比較ができる
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import websockets
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+from deadline import LatencyTracker
+from recorder import load_recording
+
+TERMINAL_TYPES = {"end", "busy", "timeout", "error"}
+RESPONSE_TYPES = {"metadata", "filler", "audio"} | TERMINAL_TYPES
+METRICS = ["first_response", "first_audio", "turn_end"]
+CLOSE_GRACE = 30.0  # セッション終了時に残りのターンを待つ最大秒数
+
+class ReplayStats:
+    def __init__(self):
+        self.latency = {metric: LatencyTracker(window=1_000_000) for metric in METRICS}
+        self.outcomes = {outcome: 0 for outcome in TERMINAL_TYPES}
+        self.turns = 0
+
+    def report(self) -> dict:
+        return {
+            "turns": self.turns,
+            "outcomes": self.outcomes,
+            **{metric: tracker.stats() for metric, tracker in self.latency.items()},
+        }
+
+class Turn:
+    def __init__(self, sent_at: float):
+        self.sent_at = sent_at
+        self.first_response: float | None = None
+        self.first_audio: float | None = None
+
+async def replay_session(url: str, events: list[dict], origin: float, speed: float, started_at: float, stats: ReplayStats) -> None:
+    """1セッション分のイベントを記録時刻に合わせて送信し、応答からターンのレイテンシを集計する"""
+    async def wait_until(ts: float) -> None:
+        delay = (ts - origin) / speed - (time.perf_counter() - started_at)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    await wait_until(events[0]["ts"])
+    async with websockets.connect(f"{url.rstrip('/')}/speech", max_size=None) as websocket:
+        # サーバーは1メッセージずつ順に処理するので、送信順に応答が返ってくる
+        # テキストを含むターンは必ずTERMINAL_TYPESのいずれかで終わる(LLMが応答しない場合はerror)
+        turns: list[Turn] = []
+        all_done = asyncio.Event()
+        all_done.set()
+
+        async def receive() -> None:
+            async for message in websocket:
+                if not turns:
+                    continue
+                turn, now = turns[0], time.perf_counter()
+                message_type = "audio" if isinstance(message, bytes) else json.loads(message).get("type")
+                if turn.first_response is None and message_type in RESPONSE_TYPES:
+                    turn.first_response = now
+                    stats.latency["first_response"].record(now - turn.sent_at)
+                if message_type == "audio" and turn.first_audio is None:
+                    turn.first_audio = now
+                    stats.latency["first_audio"].record(now - turn.sent_at)
+                if message_type in TERMINAL_TYPES:
+                    turns.pop(0)
+                    stats.outcomes[message_type] += 1
+                    if message_type == "end":
+                        stats.latency["turn_end"].record(now - turn.sent_at)
+                    if not turns:
+                        all_done.set()
+
+        receiver = asyncio.create_task(receive())
+        try:
+            for event in events:
+                await wait_until(event["ts"])
+                if event["type"] == "message":
+                    if "text" in event["data"]:
+                        turns.append(Turn(time.perf_counter()))
+                        stats.turns += 1
+                        all_done.clear()
+                    await websocket.send(json.dumps(event["data"], ensure_ascii=False))
+                elif event["type"] == "close":
+                    break
+            try:
+                await asyncio.wait_for(all_done.wait(), timeout=CLOSE_GRACE)
+            except asyncio.TimeoutError:
+                print(f"{len(turns)}件のターンが応答を返しませんでした", file=sys.stderr)
+        finally:
+            receiver.cancel()
+
+async def replay_global_events(http_url: str, events: list[dict], origin: float, speed: float, started_at: float) -> None:
+    """キャラクター変更などサーバー全体に効くイベントを再生する"""
+    async with httpx.AsyncClient(base_url=http_url) as client:
+        for event in events:
+            delay = (event["ts"] - origin) / speed - (time.perf_counter() - started_at)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if event["type"] == "character":
+                await client.post("/change_character", json={"character_name": event["character_name"]})
+
+async def run(path: Path, url: str, speed: float) -> dict:
+    sessions, global_events = load_recording(path)
+    all_events = [event for events in sessions.values() for event in events] + global_events
+    if not all_events:
+        raise ValueError(f"No events recorded in {path}")
+
+    origin = min(event["ts"] for event in all_events)
+    stats = ReplayStats()
+    started_at = time.perf_counter()
+    http_url = url.replace("ws://", "http://").replace("wss://", "https://")
+
+    results = await asyncio.gather(
+        replay_global_events(http_url, global_events, origin, speed, started_at),
+        *[replay_session(url, events, origin, speed, started_at, stats) for events in sessions.values()],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"再生中にエラーが発生しました: {result}", file=sys.stderr)
+
+    return {
+        "recording": str(path),
+        "url": url,
+        "speed": speed,
+        "sessions": len(sessions),
+        "wall_time": time.perf_counter() - started_at,
+        **stats.report(),
+    }
+
+def compare(baseline: dict, candidate: dict) -> str:
+    """2つのレポートのパーセンタイルを並べて差分(%)を表示する"""
+    lines = [f"{'metric':<24}{'baseline':>12}{'candidate':>12}{'diff':>10}"]
+    for metric in METRICS:
+        for percentile in ["p50", "p95", "p99"]:
+            a, b = baseline[metric][percentile], candidate[metric][percentile]
+            if a is None or b is None:
+                continue
+            diff = f"{(b - a) / a * 100:+.1f}%" if a else "-"
+            lines.append(f"{metric + ' ' + percentile:<24}{a:>12.3f}{b:>12.3f}{diff:>10}")
+    for outcome in sorted(TERMINAL_TYPES):
+        lines.append(f"{outcome:<24}{baseline['outcomes'][outcome]:>12}{candidate['outcomes'][outcome]:>12}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="記録した/speechセッションの再生と比較")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="記録をサーバーに対して再生する")
+    run_parser.add_argument("recording", type=Path)
+    run_parser.add_argument("--url", default="ws://localhost:8000")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="再生速度(2なら2倍速)")
+    run_parser.add_argument("--output", type=Path, help="レポートの保存先(JSON)")
+
+    compare_parser = subparsers.add_parser("compare", help="2つのレポートを比較する")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("candidate", type=Path)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        report = asyncio.run(run(args.recording, args.url, args.speed))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if args.output:
+            args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    else:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        candidate = json.loads(args.candidate.read_text(encoding="utf-8"))
+        print(compare(baseline, candidate))
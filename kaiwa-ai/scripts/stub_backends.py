@@ -0,0 +1,137 @@
+"""
+負荷試験・再生ツール用のLLM/TTSスタブサーバー
+- OpenAI互換の /v1/chat/completions (ストリーミング対応)
+- Fish-Speech互換の /v1/health, /v1/tts (msgpackリクエスト, WAVストリーミング)
+
+config.tomlで [llm.backends.openai] base_url = "http://localhost:8081/v1" とし、
+Fish-Speechの代わりにこのスタブを8080番で起動すると、GPUやAPIなしでkaiwa_serverを動かせる
+"""
+import argparse
+import io
+import json
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ormsgpack
+
+SAMPLE_RATE = 44100
+SECONDS_PER_CHAR = 0.12  # 合成音声の長さの目安
+CHUNK_SECONDS = 0.2
+
+def wav_header(data_size: int = 0) -> bytes:
+    with io.BytesIO() as wav_io:
+        with wave.open(wav_io, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(SAMPLE_RATE)
+        header = bytearray(wav_io.getvalue())
+    header[4:8] = (36 + data_size).to_bytes(4, "little")
+    header[40:44] = data_size.to_bytes(4, "little")
+    return bytes(header)
+
+def make_llm_handler(first_token_latency: float, token_interval: float):
+    class LLMHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+            user_text = body["messages"][-1]["content"]
+            tokens = [f"「{user_text[:20]}」", "ですね。", "なるほど、", "とても", "面白いです！", "もっと", "聞かせてください。"]
+            usage = {"prompt_tokens": sum(len(m["content"]) for m in body["messages"]), "completion_tokens": len(tokens), "total_tokens": 0}
+            base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body["model"]}
+
+            time.sleep(first_token_latency)
+            if not body.get("stream"):
+                time.sleep(token_interval * len(tokens))
+                payload = json.dumps({**base, "object": "chat.completion", "usage": usage, "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(tokens)}}
+                ]}, ensure_ascii=False).encode()
+                self.send_response(200)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.end_headers()
+            for token in tokens:
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": token}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(token_interval)
+            usage_chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(usage_chunk)}\n\ndata: [DONE]\n\n".encode())
+
+        def log_message(self, *args):
+            pass
+
+    return LLMHandler
+
+def make_tts_handler(first_chunk_latency: float, real_time_factor: float):
+    class TTSHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/v1/health":
+                self._send(200, b'{"status":"ok"}', "application/json")
+            else:
+                self._send(404, b"", "text/plain")
+
+        def do_POST(self):
+            request = ormsgpack.unpackb(self.rfile.read(int(self.headers["content-length"])))
+            samples = int(len(request["text"]) * SECONDS_PER_CHAR * SAMPLE_RATE)
+            chunk_samples = int(CHUNK_SECONDS * SAMPLE_RATE)
+
+            time.sleep(first_chunk_latency)
+            if not request.get("streaming"):
+                time.sleep(samples / SAMPLE_RATE * real_time_factor)
+                self._send(200, wav_header(samples * 2) + b"\x00\x00" * samples, "audio/wav")
+                return
+
+            self.send_response(200)
+            self.send_header("content-type", "audio/wav")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            self._write_chunk(wav_header())
+            for start in range(0, samples, chunk_samples):
+                size = min(chunk_samples, samples - start)
+                time.sleep(size / SAMPLE_RATE * real_time_factor)
+                self._write_chunk(b"\x00\x00" * size)
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _write_chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send(self, status: int, payload: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("content-type", content_type)
+            self.send_header("content-length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return TTSHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLM/TTSのスタブサーバーを起動する")
+    parser.add_argument("--llm-port", type=int, default=8081)
+    parser.add_argument("--tts-port", type=int, default=8080)
+    parser.add_argument("--llm-first-token-latency", type=float, default=0.4)
+    parser.add_argument("--llm-token-interval", type=float, default=0.03)
+    parser.add_argument("--tts-first-chunk-latency", type=float, default=0.2)
+    parser.add_argument("--tts-real-time-factor", type=float, default=0.3)
+    args = parser.parse_args()
+
+    servers = [
+        ThreadingHTTPServer(("0.0.0.0", args.llm_port), make_llm_handler(args.llm_first_token_latency, args.llm_token_interval)),
+        ThreadingHTTPServer(("0.0.0.0", args.tts_port), make_tts_handler(args.tts_first_chunk_latency, args.tts_real_time_factor)),
+    ]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"LLMスタブ: http://localhost:{args.llm_port}/v1, TTSスタブ: http://localhost:{args.tts_port}")
+    servers[0].serve_forever()
@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+
+from deadline import DeadlineExceeded, deadline_var
+
+# WebSocket接続ごとに設定するセッションID(LLM/TTSの呼び出し元を区別するために使用)
+session_id_var: ContextVar[str] = ContextVar("session_id", default="default")
+
+class BackendBusyError(Exception):
+    """バックエンドの同時実行数と待ち行列が埋まっていて、リクエストを受け付けられない"""
+    def __init__(self, backend: str):
+        self.backend = backend
+        super().__init__(f"{backend} is busy, please try again later")
+
+class AdmissionController:
+    """
+    バックエンドへの同時リクエスト数を制限するアドミッション制御
+    待ち行列はセッションごとに分け、空きが出たらセッション間でラウンドロビンに割り当てる
+    max_queue_wait秒以内に順番が来なければBackendBusyErrorで拒否する(ターンの期限が先に切れる場合はDeadlineExceeded)
+    """
+    def __init__(self, name: str, max_concurrency: int | None = None, max_queue_wait: float = 5.0, max_queue_size: int | None = None, stats_window: int = 1000):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue_wait = max_queue_wait
+        self.max_queue_size = max_queue_size
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self._wait_times: deque[float] = deque(maxlen=stats_window)
+
+    @classmethod
+    def from_config(cls, name: str, config: dict, **defaults) -> "AdmissionController":
+        """config.tomlの[admission.<name>]から設定を読み込む"""
+        settings = {**defaults, **config.get("admission", {}).get(name, {})}
+        return cls(name, **settings)
+
+    @asynccontextmanager
+    async def acquire(self, session_id: str | None = None) -> AsyncIterator[None]:
+        session_id = session_id or session_id_var.get()
+        start_time = time.perf_counter()
+        await self._enter(session_id)
+        self._wait_times.append(time.perf_counter() - start_time)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self) -> bool:
+        """
+        待たずに枠が取れる場合だけ取る(取れたらrelease()で返すこと)
+        ヘッジや先読みなど、枠がなければ諦めてよい追加のリクエストに使う
+        """
+        if self.max_concurrency is not None and (self.in_flight >= self.max_concurrency or self.queued):
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    async def _enter(self, session_id: str) -> None:
+        if self.max_concurrency is None or (self.in_flight < self.max_concurrency and not self.queued):
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        if self.max_queue_size is not None and self.queued >= self.max_queue_size:
+            self.rejected += 1
+            raise BackendBusyError(self.name)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session_id, deque()).append(future)
+        self.queued += 1
+
+        # ターンの期限が先に来る場合は、それ以上待っても応答が間に合わないので期限までしか待たない
+        deadline = deadline_var.get()
+        max_wait = min(self.max_queue_wait, deadline.remaining()) if deadline else self.max_queue_wait
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not future.done():
+                self._remove_waiter(session_id, future)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected += 1
+                    if max_wait < self.max_queue_wait:
+                        raise DeadlineExceeded(self.name) from None
+                    raise BackendBusyError(self.name) from None
+                raise
+            if isinstance(e, asyncio.CancelledError):
+                # 枠が割り当てられた直後にキャンセルされた場合は返却する
+                self.release()
+                raise
+            # タイムアウトと同時に枠が割り当てられた場合はそのまま受け入れる
+
+        self.admitted += 1
+
+    def _remove_waiter(self, session_id: str, future: asyncio.Future) -> None:
+        waiters = self._waiters.get(session_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[session_id]
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        # 空いた枠は待っているセッションへ順番に渡す(in_flightは渡した時点で加算する)
+        while self._waiters and (self.max_concurrency is None or self.in_flight < self.max_concurrency):
+            session_id, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(session_id)
+            else:
+                del self._waiters[session_id]
+            future.set_result(None)
+            self.in_flight += 1
+
+    def stats(self) -> dict:
+        wait_times = sorted(self._wait_times)
+
+        def percentile(p: float) -> float:
+            return wait_times[min(len(wait_times) - 1, int(p * len(wait_times)))] if wait_times else 0.0
+
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait": {
+                "mean": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": wait_times[-1] if wait_times else 0.0,
+            },
+        }
@@ -0,0 +1,154 @@
+import struct
+import numpy as np
+
+from schemes import AudioFormatRequest
+from tts import AMPLITUDE, WavFormat, parse_wav_stream_header
+
+FIR_TAPS = 63  # リサンプリング前のローパスフィルタのタップ数(奇数)
+TARGET_LOUDNESS_DBFS = -20.0  # ラウドネス正規化の目標RMS
+MAX_GAIN = 8.0  # 無音付近でノイズを持ち上げすぎないための上限
+GAIN_SMOOTHING = 0.2  # チャンク間でゲインを滑らかに変化させる係数
+SILENCE_RMS = 1e-4
+
+def make_wav_stream_header(wav_format: WavFormat, data_size: int = 0) -> bytes:
+    """WAVヘッダーを生成(ストリーミングではdata_sizeは未確定のため0)"""
+    format_tag = 3 if wav_format.bits_per_sample == 32 else 1  # 3: IEEE float, 1: PCM
+    block_align = wav_format.channels * wav_format.bits_per_sample // 8
+    return b''.join([
+        b'RIFF', struct.pack('<I', 36 + data_size), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHH', 16, format_tag, wav_format.channels, wav_format.sample_rate,
+                             wav_format.bytes_per_second, block_align, wav_format.bits_per_sample),
+        b'data', struct.pack('<I', data_size),
+    ])
+
+def design_lowpass(cutoff: float, taps: int = FIR_TAPS) -> np.ndarray:
+    """窓関数法によるローパスFIR (cutoffは入力サンプルレートに対する比, 0.5がナイキスト)"""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+class AudioStreamProcessor:
+    """
+    Fish-Speechが返す16bit WAVストリームを、接続ごとに決めたフォーマットへチャンク単位で変換する
+    チャンク境界をまたぐ状態(端数バイト, フィルタ履歴, 補間位置, ゲイン)はインスタンスに保持する
+    """
+    def __init__(self, requested: AudioFormatRequest):
+        self.requested = requested
+        self.input_format: WavFormat | None = None
+        self.output_format: WavFormat | None = None
+        self._pending = b""
+        self._taps: np.ndarray | None = None
+        self._history: np.ndarray | None = None
+        self._skip = 0
+        self._step = 1.0
+        self._position = 0.0
+        self._last: np.ndarray | None = None
+        self._gain = 1.0
+
+    def _setup(self, input_format: WavFormat) -> None:
+        if input_format.bits_per_sample != 16:
+            raise ValueError(f"Unsupported WAV stream: {input_format.bits_per_sample} bits per sample")
+
+        self.input_format = input_format
+        self.output_format = WavFormat(
+            sample_rate=self.requested.sample_rate or input_format.sample_rate,
+            channels=self.requested.channels or input_format.channels,
+            bits_per_sample=32 if self.requested.encoding == "float32" else 16,
+        )
+        self._step = input_format.sample_rate / self.output_format.sample_rate
+        if self._step != 1.0:
+            # ダウンサンプリング時は出力ナイキストより少し下で帯域制限してエイリアスを防ぐ
+            cutoff = 0.5 * min(1.0, 1.0 / self._step) * 0.9
+            self._taps = design_lowpass(cutoff)
+            delay = (len(self._taps) - 1) // 2
+            self._history = np.zeros((len(self._taps) - 1, self.output_format.channels), dtype=np.float32)
+            self._skip = delay
+
+    def process(self, chunk: bytes) -> bytes:
+        """WAVストリームのチャンクを変換する。最初の出力には変換後のWAVヘッダーが付く"""
+        data = self._pending + chunk
+        self._pending = b""
+
+        header = b""
+        if self.input_format is None:
+            parsed = parse_wav_stream_header(data)
+            if parsed is None:
+                self._pending = data
+                return b""
+            input_format, header_length = parsed
+            self._setup(input_format)
+            header = make_wav_stream_header(self.output_format)
+            data = data[header_length:]
+
+        frame_size = self.input_format.channels * 2
+        usable = len(data) - len(data) % frame_size
+        self._pending = data[usable:]
+        if usable == 0:
+            return header
+
+        samples = np.frombuffer(data[:usable], dtype='<i2').astype(np.float32) / AMPLITUDE
+        return header + self._encode(self._transform(samples.reshape(-1, self.input_format.channels)))
+
+    def flush(self) -> bytes:
+        """フィルタの遅延分を押し出して残りのサンプルを返す"""
+        if self.input_format is None or self._taps is None:
+            return b""
+        padding = np.zeros(((len(self._taps) - 1) // 2, self.input_format.channels), dtype=np.float32)
+        return self._encode(self._transform(padding))
+
+    def _transform(self, frames: np.ndarray) -> np.ndarray:
+        if self.output_format.channels == 1 and frames.shape[1] > 1:
+            frames = frames.mean(axis=1, keepdims=True)
+        elif self.output_format.channels > frames.shape[1]:
+            frames = np.repeat(frames, self.output_format.channels, axis=1)
+
+        if self._taps is not None:
+            frames = self._resample(frames)
+
+        if self.requested.normalize and len(frames):
+            frames = self._normalize(frames)
+
+        return frames
+
+    def _resample(self, frames: np.ndarray) -> np.ndarray:
+        # 前チャンク末尾の履歴をつなげてFIRをかける
+        extended = np.concatenate([self._history, frames])
+        self._history = extended[-(len(self._taps) - 1):]
+        filtered = np.stack(
+            [np.convolve(extended[:, channel], self._taps, mode='valid') for channel in range(extended.shape[1])],
+            axis=1,
+        )
+        if self._skip:
+            dropped = min(self._skip, len(filtered))
+            filtered = filtered[dropped:]
+            self._skip -= dropped
+
+        # 前チャンクの最終サンプルを先頭に置き、境界をまたいで線形補間する
+        buffer = filtered if self._last is None else np.concatenate([self._last, filtered])
+        if len(buffer) < 2:
+            self._last = buffer[-1:] if len(buffer) else self._last
+            return np.zeros((0, frames.shape[1]), dtype=np.float32)
+
+        positions = np.arange(self._position, len(buffer) - 1, self._step)
+        self._position = (positions[-1] + self._step if len(positions) else self._position) - (len(buffer) - 1)
+        self._last = buffer[-1:]
+
+        index = positions.astype(np.int64)
+        fraction = (positions - index)[:, None].astype(np.float32)
+        return buffer[index] * (1 - fraction) + buffer[index + 1] * fraction
+
+    def _normalize(self, frames: np.ndarray) -> np.ndarray:
+        rms = float(np.sqrt(np.mean(np.square(frames))))
+        previous_gain = self._gain
+        if rms > SILENCE_RMS:
+            target_gain = min(MAX_GAIN, 10 ** (TARGET_LOUDNESS_DBFS / 20) / rms)
+            self._gain += (target_gain - self._gain) * GAIN_SMOOTHING
+        # チャンク内で前回のゲインから線形に変化させ、チャンクの境界でゲインが跳ねないようにする
+        ramp = np.linspace(previous_gain, self._gain, len(frames), dtype=np.float32)[:, None]
+        return frames * ramp
+
+    def _encode(self, frames: np.ndarray) -> bytes:
+        frames = np.clip(frames, -1.0, 1.0)
+        if self.output_format.bits_per_sample == 32:
+            return frames.astype('<f4').tobytes()
+        return (frames * (AMPLITUDE - 1)).astype('<i2').tobytes()
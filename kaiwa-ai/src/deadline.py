@@ -0,0 +1,157 @@
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Awaitable, Callable, TypeVar
+
+if TYPE_CHECKING:
+    from admission import AdmissionController
+
+T = TypeVar("T")
+
+# 残り時間のうち各ステージに割り当てる割合(後続ステージの分を残しておく)
+STAGE_SHARES = {
+    "llm": 0.6,
+    "emotion": 0.3,
+    "tts": 1.0,
+}
+MIN_STAGE_TIMEOUT = 0.5
+# ターンの外(フィラーの事前生成など)で使うステージごとのタイムアウト(秒)
+DEFAULT_STAGE_TIMEOUTS = {
+    "llm": 30.0,
+    "emotion": 10.0,
+    "tts": 30.0,
+}
+
+class DeadlineExceeded(Exception):
+    """ターンの期限内にステージが終わらなかった"""
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f"Turn deadline exceeded during {stage}")
+
+class Deadline:
+    """ユーザー入力を受け取った時点から数えるターン全体の期限"""
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def check(self, stage: str) -> None:
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage: str) -> float:
+        """残り時間からステージのタイムアウトを決める(期限切れならDeadlineExceeded)"""
+        self.check(stage)
+        remaining = self.remaining()
+        return max(min(remaining, MIN_STAGE_TIMEOUT), remaining * STAGE_SHARES.get(stage, 1.0))
+
+# WebSocketのターンごとに設定し、LLM/感情分析/TTSへ伝搬させる
+deadline_var: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+def stage_timeout(stage: str) -> float | None:
+    """
+    現在のターンの期限からステージのタイムアウトを返す
+    期限がなければDEFAULT_STAGE_TIMEOUTSの値(未登録のステージはNoneで無制限)
+    """
+    deadline = deadline_var.get()
+    return deadline.timeout(stage) if deadline else DEFAULT_STAGE_TIMEOUTS.get(stage)
+
+def check_deadline(stage: str) -> None:
+    deadline = deadline_var.get()
+    if deadline:
+        deadline.check(stage)
+
+class LatencyTracker:
+    """直近のレイテンシを保持してパーセンタイルを計算する"""
+    def __init__(self, window: int = 500):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def percentile(self, p: float) -> float | None:
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def stats(self) -> dict:
+        return {
+            "count": len(self._samples),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+async def hedged(call: Callable[[], Awaitable[T]], hedge_after: float | None, admission: "AdmissionController | None" = None) -> T:
+    """
+    callを実行し、hedge_after秒以内に終わらなければ同じcallをもう1つ投げて先に成功した方を返す
+    admissionを渡すと2本目の分の枠を待たずに取り、空きがなければヘッジせずに1本目を待つ
+    冪等でキャンセルできる呼び出しにだけ使うこと
+    """
+    first = asyncio.ensure_future(call())
+    if hedge_after is None:
+        return await first
+
+    pending = {first}
+    hedge_slot = False
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        if admission is not None:
+            if not admission.try_acquire():
+                return await first
+            hedge_slot = True
+        pending.add(asyncio.ensure_future(call()))
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        if hedge_slot:
+            admission.release()
+
+class HedgePolicy:
+    """
+    バックエンドごとのヘッジ設定
+    レイテンシが直近のpercentileを超えたら2本目のリクエストを投げる(サンプルが揃うまではヘッジしない)
+    """
+    def __init__(self, enabled: bool = False, percentile: float = 0.95, min_samples: int = 20, window: int = 500):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latency = LatencyTracker(window)
+
+    @classmethod
+    def from_config(cls, name: str, config: dict) -> "HedgePolicy":
+        """config.tomlの[hedge.<name>]から設定を読み込む"""
+        return cls(**config.get("hedge", {}).get(name, {}))
+
+    def hedge_after(self) -> float | None:
+        if not self.enabled or len(self.latency) < self.min_samples:
+            return None
+        return self.latency.percentile(self.percentile)
+
+    async def run(self, call: Callable[[], Awaitable[T]], admission: "AdmissionController | None" = None) -> T:
+        start_time = time.perf_counter()
+        result = await hedged(call, self.hedge_after(), admission)
+        self.latency.record(time.perf_counter() - start_time)
+        return result
@@ -37,6 +37,45 @@ def split_sentence(text):
     
     return sentences
 
+def _is_decimal_point(text, index):
+    return text[index] == '.' and 0 < index < len(text) - 1 and text[index - 1].isdigit() and text[index + 1].isdigit()
+
+def split_sentence_spans(text):
+    """
+    原文を文末で区切り、(原文の文, 感情分析用の文)のリストを返す
+    MeCabの形態素を原文上の位置に対応させて切るので、原文の文は空白や小数点を含めてLLMの出力そのまま(TTS用)
+    感情分析用の文はsplit_sentenceと同じく絵文字を除いて形態素を連結したもの
+    """
+    tagger = MeCab.Tagger()
+    parsed = tagger.parse(remove_emoji(text))
+    words = [line.split('\t')[0] for line in parsed.split('\n') if line][:-1]
+    sentence_endings = {'.', '！', '？', '。', '!', '?'}
+
+    spans = []  # [原文の開始位置, 原文の終了位置, 感情分析用の文]
+    current_sentence = []
+    start = 0
+    position = 0
+
+    def close_sentence(end):
+        classifier_input = ''.join(current_sentence).strip()
+        if classifier_input:
+            spans.append([start, end, classifier_input])
+        elif spans:
+            spans[-1][1] = end  # 絵文字だけの残りなどは直前の文にくっつける
+
+    for word in words:
+        found = text.find(word, position)
+        current_sentence.append(word)
+        if found == -1:
+            continue
+        position = found + len(word)
+        if word in sentence_endings and not _is_decimal_point(text, found):
+            close_sentence(position)
+            start = position
+            current_sentence = []
+
+    close_sentence(len(text))
+    return [(text[begin:end].strip(), classifier_input) for begin, end, classifier_input in spans]
 
 class SentimentAnalyzer:
     """
@@ -63,11 +102,21 @@ class SentimentAnalyzer:
         }
         
     def analyze(self, input: str) -> int:
+        return self.analyze_batch([input])[0]
+
+    def analyze_batch(self, inputs: list[str]) -> list[int]:
+        """
+        複数の文を1回のforwardでまとめて分類する
+        パディングはバッチ内の最長文に合わせる
+        """
+        if not inputs:
+            return []
+
         max_seq_length = 512
-        token = self.tokenizer(input,
+        token = self.tokenizer(inputs,
                                truncation=True,
                                max_length=max_seq_length,
-                               padding="max_length",
+                               padding=True,
                                return_tensors="pt")
         
         input_ids = token['input_ids'].to(self.device)
@@ -76,10 +125,8 @@ class SentimentAnalyzer:
         with torch.no_grad():
             output = self.model(input_ids, attention_mask=attention_mask)
         
-        max_index = torch.argmax(output.logits).item()
-        mapped_emotion = self.emotion_mapping.get(max_index, 0)  # デフォルトは0 (normal)
-        
-        return mapped_emotion
+        max_indices = torch.argmax(output.logits, dim=-1).tolist()
+        return [self.emotion_mapping.get(index, 0) for index in max_indices]  # デフォルトは0 (normal)
 
 if __name__ == "__main__":
     analyzer = SentimentAnalyzer()
@@ -88,3 +135,4 @@ if __name__ == "__main__":
     end_time = time.time()
     print(f"推論時間: {end_time - start_time} seconds")
     print(f"感情ラベル: {result}")
+    print(f"文ごとの感情ラベル: {analyzer.analyze_batch(split_sentence('すごく楽しかった。また行きたい。'))}")
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import random
+from pydantic import BaseModel
+
+from audio import make_wav_stream_header
+from tts import FishSpeechTTS, WavFormat
+
+DEFAULT_FILLERS = ["えーと", "うんうん", "そうですね", "なるほど", "うーん"]
+
+class FillerClip(BaseModel):
+    text: str
+    wav: bytes  # ヘッダー付きの完結したWAV
+
+class FillerAudioCache:
+    """
+    LLMの応答待ちを埋めるフィラー音声をキャラクターごとにメモリへ保持する
+    合成は起動時やキャラクター登録時にバックグラウンドで行い、会話のクリティカルパスではTTSを呼ばない
+    """
+    def __init__(self, tts_model: FishSpeechTTS):
+        self.tts_model = tts_model
+        self.clips: dict[str, list[FillerClip]] = {}
+        self._last_text: dict[str, str] = {}
+
+    async def prepare(self, characters: dict, priority: str | None = None) -> None:
+        """全キャラクターのフィラーを合成する(priorityのキャラクターを先に処理)"""
+        names = sorted(characters, key=lambda name: name != priority)
+        for name in names:
+            await self.prepare_character(name, characters[name])
+
+    async def prepare_character(self, name: str, character: dict) -> None:
+        reference_id = character.get("reference_id", name)
+        clips = []
+        for text in character.get("fillers", DEFAULT_FILLERS):
+            try:
+                # requestsは同期処理なので、イベントループを止めないようスレッドで合成する
+                async with self.tts_model.admission.acquire("filler"):
+                    sample_rate, audio_data = await asyncio.to_thread(self.tts_model.synthesize, text, reference_id)
+            except Exception as e:
+                logging.warning(f"Failed to synthesize filler '{text}' for {name}: {e}")
+                continue
+            wav_format = WavFormat(sample_rate=sample_rate, channels=1, bits_per_sample=16)
+            clips.append(FillerClip(text=text, wav=make_wav_stream_header(wav_format, len(audio_data)) + audio_data))
+
+        if clips:
+            self.clips[name] = clips
+            logging.info(f"Prepared {len(clips)} filler clips for {name}")
+
+    def pick(self, name: str) -> FillerClip | None:
+        """直前と同じフィラーが続かないように1つ選ぶ。未準備の場合はNone"""
+        clips = self.clips.get(name)
+        if not clips:
+            return None
+        candidates = [clip for clip in clips if clip.text != self._last_text.get(name)] or clips
+        clip = random.choice(candidates)
+        self._last_text[name] = clip.text
+        return clip
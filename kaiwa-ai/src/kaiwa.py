@@ -1,11 +1,14 @@
+import asyncio
 import logging
 from pathlib import Path
 import base64
 
 from llm import LLMModel
 from tts import FishSpeechTTS
-from emotion_analysis import SentimentAnalyzer
-from schemes import Message, KaiwaResponse
+from emotion_analysis import SentimentAnalyzer, split_sentence_spans, remove_emoji
+from schemes import Message, KaiwaResponse, EmotionSegment
+from admission import AdmissionController, BackendBusyError
+from deadline import DeadlineExceeded
 
 class Kaiwa:
     def __init__(self, llm_model: LLMModel, tts_model: FishSpeechTTS, analyzer: SentimentAnalyzer, character_name="uzuki"):
@@ -59,18 +62,58 @@ class Kaiwa:
                 self.current_text = ""
                 return None
 
+        except (BackendBusyError, DeadlineExceeded, asyncio.CancelledError):
+            # 応答できなかったユーザー発話を残すと、次のターンで同じ発話が二重に送られる
+            self.rollback_turn(user_message)
+            self.current_text = ""
+            raise
+
         except Exception as e:
             logging.error(f"LLM応答生成中にエラーが発生しました: {e}")
             self.current_text = ""
             return None
 
+    def rollback_turn(self, user_message: str, llm_response: str | None = None) -> None:
+        """拒否や期限切れで応答を届けられなかったターンの発話を履歴から取り除く"""
+        for role, content in (("assistant", llm_response), ("user", user_message)):
+            if content is None:
+                continue
+            # 他のセッションの発話が後ろに積まれている場合があるので、末尾から探して取り除く
+            for index in range(len(self.conversation_history) - 1, -1, -1):
+                message = self.conversation_history[index]
+                if message.role == role and message.content == content:
+                    del self.conversation_history[index]
+                    break
+
+    def analyze_emotion_timeline(self, text: str) -> list[EmotionSegment]:
+        """
+        応答を文単位に分割し、全文の感情を1回のバッチ推論でまとめて分類する
+        EmotionSegment.textはTTSに渡すので原文のまま、分類には形態素を連結した文を使う
+        """
+        spans = split_sentence_spans(text) or [(text, remove_emoji(text))]
+        emotions = self.analyzer.analyze_batch([classifier_input for _, classifier_input in spans])
+        return [EmotionSegment(text=sentence, emotion=emotion) for (sentence, _), emotion in zip(spans, emotions)]
+
     def get_recent_history(self, max_history: int = 20) -> list[Message]:
         return self.conversation_history[-max_history:]
 
 
+def dominant_emotion(segments: list[EmotionSegment]) -> int:
+    """文字数で重み付けして、応答全体を代表する感情を選ぶ"""
+    weights: dict[int, int] = {}
+    for segment in segments:
+        weights[segment.emotion] = weights.get(segment.emotion, 0) + len(segment.text)
+    return max(weights, key=weights.get) if weights else 0
+
+
 def create_kaiwa(config, characters: dict, character_name: str) -> Kaiwa:
     llm_model = LLMModel(config, character_name=character_name)
-    tts_model = FishSpeechTTS()
+    tts_config = config.get("tts", {})
+    tts_model = FishSpeechTTS(
+        admission=AdmissionController.from_config("tts", config, max_concurrency=4),
+        lookahead=tts_config.get("lookahead", 1),
+        prefetch_budget=tts_config.get("prefetch_budget", 4 * 1024 * 1024)
+    )
     tts_model.update_model(characters[character_name]["reference_id"])
     analyzer = SentimentAnalyzer()
     
@@ -1,13 +1,21 @@
 import asyncio
 import logging
 import json
+import uuid
+from contextlib import aclosing
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
 
-from kaiwa import create_kaiwa, Kaiwa
-from schemes import CharacterChangeRequest
+from kaiwa import create_kaiwa, dominant_emotion, Kaiwa
+from schemes import AudioFormatRequest, CharacterChangeRequest, EmotionSegment
+from admission import BackendBusyError, session_id_var
+from deadline import Deadline, DeadlineExceeded, LatencyTracker, deadline_var, stage_timeout
+from audio import AudioStreamProcessor
+from filler import FillerAudioCache, FillerClip
+from llm_backend import backend_stats
+from recorder import SessionRecorder
 from log import setup_logging
 from config_loader import load_config, load_character
 
@@ -38,44 +46,189 @@ app.add_middleware(
 # Kaiwaのインスタンスを作成
 kaiwa: Kaiwa = create_kaiwa(config, characters, CHARACTER_NAME)
 
+# LLMの応答がこの秒数を超えたらフィラー音声を先に流す
+FILLER_THRESHOLD = config.get("filler", {}).get("threshold", 0.8)
+FILLER_ENABLED = config.get("filler", {}).get("enabled", True)
+fillers = FillerAudioCache(kaiwa.tts_model)
+background_tasks: set[asyncio.Task] = set()
+
+# ユーザー入力を受け取ってから応答音声を送り終えるまでの期限(秒)
+TURN_BUDGET = config.get("deadline", {}).get("turn_budget", 20.0)
+# ターンの所要時間は結果ごとに分けて記録する(拒否や期限切れのターンも含める)
+TURN_OUTCOMES = ["end", "no_reply", "busy", "timeout", "error"]
+turn_latency = {outcome: LatencyTracker() for outcome in TURN_OUTCOMES}
+
+# 再生ツール(scripts/replay.py)用にセッションを記録する
+recording = config.get("recording", {})
+recorder = SessionRecorder(Path(recording.get("path", Path(__file__).parent / "recordings" / "sessions.jsonl"))) if recording.get("enabled") else None
+
+@app.on_event("startup")
+async def prepare_fillers():
+    if FILLER_ENABLED:
+        task = asyncio.create_task(fillers.prepare(characters, priority=CHARACTER_NAME))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def send_filler(websocket: WebSocket, clip: FillerClip, audio_format: AudioFormatRequest) -> None:
+    """メモリ上のフィラー音声を1つの完結したWAVとして送る"""
+    audio = clip.wav
+    if not audio_format.is_passthrough():
+        processor = AudioStreamProcessor(audio_format)
+        audio = processor.process(audio) + processor.flush()
+
+    await websocket.send_text(json.dumps({"type": "filler", "text": clip.text}))
+    await websocket.send_bytes(audio)
+
+async def generate_llm_response_with_filler(websocket: WebSocket, user_message: str, audio_format: AudioFormatRequest) -> str | None:
+    """LLMの応答が閾値内に返らなければフィラーを流し、その後に本来の応答を返す"""
+    llm_task = asyncio.create_task(kaiwa.generate_llm_response(user_message))
+    try:
+        if FILLER_ENABLED:
+            done, _ = await asyncio.wait({llm_task}, timeout=FILLER_THRESHOLD)
+            if not done and (clip := fillers.pick(kaiwa.character)):
+                await send_filler(websocket, clip, audio_format)
+        return await llm_task
+    finally:
+        # フィラー送信の失敗や切断でここまで来たときにLLMのタスクを置き去りにしない
+        if not llm_task.done():
+            llm_task.cancel()
+
+async def stream_reply(websocket: WebSocket, llm_response: str, audio_format: AudioFormatRequest) -> None:
+    """
+    LLMの応答を文単位の感情タイムラインとともに音声ストリーミングする
+    各文の音声の先頭で"emotion"を送り、"end"で確定したoffset/durationを返す
+    TTSの枠は呼び出し側でkaiwa.tts_model.reserve()により確保しておくこと
+    """
+    # 期限切れでstage_timeoutが送出した場合に、待たれないコルーチンを作らないよう先に求める
+    emotion_timeout = stage_timeout("emotion")
+    try:
+        segments = await asyncio.wait_for(
+            asyncio.to_thread(kaiwa.analyze_emotion_timeline, llm_response),
+            timeout=emotion_timeout
+        )
+    except asyncio.TimeoutError:
+        # 感情分析が間に合わない場合は音声を優先し、normalのまま送る
+        logging.warning("Emotion analysis timed out, falling back to neutral emotion")
+        segments = [EmotionSegment(text=llm_response, emotion=0)]
+
+    # メタデータを送信
+    response_data = {
+        "type": "metadata",
+        "text": llm_response,
+        "emotion": dominant_emotion(segments),
+        "emotions": [segment.model_dump() for segment in segments]
+    }
+    await websocket.send_text(json.dumps(response_data))
+
+    # 接続ごとに指定されたフォーマットへ変換する(指定がなければそのまま送る)
+    processor = None if audio_format.is_passthrough() else AudioStreamProcessor(audio_format)
+
+    # Fish-Speechのストリーミングレスポンスを文ごとに処理
+    offset = 0.0
+    current_index = -1
+    # 送信が途中で失敗した場合もすぐにジェネレーターを閉じ、先読み中の合成を止める
+    async with aclosing(kaiwa.tts_model.stream_speak_sentences([segment.text for segment in segments], reserved=True)) as stream:
+        async for index, chunk, duration in stream:
+            if processor:
+                chunk = processor.process(chunk)
+            if index != current_index and duration > 0:
+                current_index = index
+                segments[index].offset = offset
+                await websocket.send_text(json.dumps({
+                    "type": "emotion",
+                    "index": index,
+                    "emotion": segments[index].emotion,
+                    "offset": offset
+                }))
+            segments[index].duration += duration
+            offset += duration
+            if chunk:  # チャンクが空でない場合のみ送信
+                await websocket.send_bytes(chunk)
+
+    if processor and (tail := processor.flush()):
+        await websocket.send_bytes(tail)
+
+    # 音声生成完了を通知
+    await websocket.send_text(json.dumps({
+        "type": "end",
+        "timeline": [segment.model_dump() for segment in segments]
+    }))
+
+async def run_turn(websocket: WebSocket, user_message: str, audio_format: AudioFormatRequest) -> None:
+    """ユーザー入力1つ分のターンを処理し、結果にかかわらず所要時間を記録する"""
+    # ターンの期限を設定し、LLM/感情分析/TTSの各ステージへ伝搬させる
+    deadline = Deadline(TURN_BUDGET)
+    deadline_var.set(deadline)
+    outcome = "error"
+    try:
+        llm_response = await generate_llm_response_with_filler(websocket, user_message, audio_format)
+        if not llm_response:
+            # 応答がない場合もターンの終わりをクライアントへ知らせる
+            outcome = "no_reply"
+            await websocket.send_text(json.dumps({"type": "error", "message": "No response from LLM"}))
+            return
+        try:
+            # TTSの枠はLLMの応答が揃ってから取る(LLMを待つ間に枠を塞がない)
+            # メタデータを送る前に取るので、混雑時は何も送らずにbusyを返して履歴を戻す
+            async with kaiwa.tts_model.reserve():
+                await stream_reply(websocket, llm_response, audio_format)
+        except (BackendBusyError, DeadlineExceeded):
+            kaiwa.rollback_turn(user_message, llm_response)
+            raise
+        outcome = "end"
+    except BackendBusyError:
+        outcome = "busy"
+        raise
+    except DeadlineExceeded:
+        outcome = "timeout"
+        raise
+    finally:
+        turn_latency[outcome].record(deadline.elapsed())
+
 @app.websocket("/speech")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("WebSocket接続が確立されました")
+    session_id = uuid.uuid4().hex
+    session_id_var.set(session_id)
+    audio_format = AudioFormatRequest()
+    if recorder:
+        recorder.record("open", session_id)
     
     try:
         while True:
             try:
                 data = await asyncio.wait_for(websocket.receive_text(), timeout=60.0)
                 parsed_data = json.loads(data)
+                if recorder:
+                    recorder.record("message", session_id, data=parsed_data)
+
+                # 音声フォーマットのネゴシエーション
+                if 'audio_format' in parsed_data:
+                    audio_format = AudioFormatRequest(**parsed_data['audio_format'])
+                    await websocket.send_text(json.dumps({"type": "audio_format", **audio_format.model_dump()}))
 
                 if 'text' in parsed_data:
                     user_message = kaiwa.process_speech_input(parsed_data['text'])
                     
                     if user_message:
-                        llm_response = await kaiwa.generate_llm_response(user_message)
-                        if llm_response:
-                            # テタデータを送信
-                            response_data = {
-                                "type": "metadata",
-                                "text": llm_response,
-                                "emotion": kaiwa.analyzer.analyze(llm_response)
-                            }
-                            await websocket.send_text(json.dumps(response_data))
-
-                            # Fish-Speechのストリーミングレスポンスを処理
-                            async for chunk in kaiwa.tts_model.stream_speak(llm_response):
-                                if chunk:  # チャンクが空でない場合のみ送信
-                                    await websocket.send_bytes(chunk)
-
-                            # 音声生成完了を通知
-                            await websocket.send_text(json.dumps({"type": "end"}))
+                        await run_turn(websocket, user_message, audio_format)
 
             except asyncio.TimeoutError:
                 print("タイムアウトが発生しました。接続を維持します。")
                 continue
             except json.JSONDecodeError:
                 print(f"無効なJSONデータを受信しました: {data}")
+            except BackendBusyError as e:
+                # 混雑時は新しいターンを受け付けず、明示的に通知する(入力は破棄して再送してもらう)
+                logging.warning(f"Turn rejected: {e}")
+                kaiwa.current_text = ""
+                busy_data = {"type": "busy", "backend": e.backend, "message": str(e)}
+                await websocket.send_text(json.dumps(busy_data))
+            except DeadlineExceeded as e:
+                logging.warning(f"Turn timed out: {e}")
+                timeout_data = {"type": "timeout", "stage": e.stage, "message": str(e)}
+                await websocket.send_text(json.dumps(timeout_data))
             except Exception as e:
                 print(f"メッセージの処理中にエラーが発生しました: {e}")
                 error_data = {"type": "error", "message": str(e)}
@@ -83,6 +236,9 @@ async def websocket_endpoint(websocket: WebSocket):
 
     except WebSocketDisconnect:
         print("WebSocket接続が閉じられました")
+    finally:
+        if recorder:
+            recorder.record("close", session_id)
 
 # キャラクターを変更するエンドポイント
 @app.post("/change_character")
@@ -93,9 +249,12 @@ async def change_character(request: CharacterChangeRequest):
         raise HTTPException(status_code=400, detail="Character not found")
     
     try:
+        # 未設定のllm_backendなどで失敗しうるLLMを先に切り替え、失敗したら声もキャラクターも変えない
+        kaiwa.llm_model.set_character(character)
         kaiwa.character = character
-        kaiwa.tts_model.update_model(character)  # reference_idとしてキャラクター名を使用
-        kaiwa.llm_model.set_system_prompt(Path(characters[character]["prompt_path"]))
+        kaiwa.tts_model.update_model(characters[character]["reference_id"])
+        if recorder:
+            recorder.record("character", character_name=character)
         kaiwa.conversation_history = []
         
         return JSONResponse(
@@ -139,6 +298,16 @@ async def change_prompt(character: str | None = None, raw_prompt: str | None = N
         logging.error(f"Failed to update prompt: {e}")
         raise HTTPException(status_code=500, detail="Failed to update prompt")
     
+# LLM/TTSの同時実行数と待ち時間の統計を取得するエンドポイント
+@app.get("/stats")
+async def get_stats():
+    return {
+        "llm": kaiwa.llm_model.admission.stats(),
+        "tts": kaiwa.tts_model.admission.stats(),
+        "llm_backends": backend_stats(),
+        "turn_latency": {outcome: tracker.stats() for outcome, tracker in turn_latency.items()},
+    }
+
 # ルートエンドポイント
 @app.get("/")
 async def root():
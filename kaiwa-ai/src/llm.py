@@ -1,12 +1,15 @@
 import logging
-from openai import AsyncOpenAI
+from openai import APITimeoutError
 from pydantic import BaseModel
 from pathlib import Path
+from typing import AsyncIterator
 
 from schemes import Message
+from admission import AdmissionController
+from deadline import DeadlineExceeded, HedgePolicy, stage_timeout
+from llm_backend import DEFAULT_BACKEND, LLMBackend, get_backend
 from config_loader import load_config, load_character
 
-MODEL = "gpt-4o-mini"
 config = load_config()
 characters = load_character()
 
@@ -17,13 +20,24 @@ class Message(BaseModel):
 
 class LLMModel:
     def __init__(self, config: dict, character_name: str, max_token: int = 300):
-        self.api_key = config["openai"]["api_key"]
-        if not self.api_key:
-            raise ValueError("OpenAI API key not found in environment variables")
-        self.openai = AsyncOpenAI(api_key=self.api_key)
+        self.config = config
+        self.admission = AdmissionController.from_config("llm", config, max_concurrency=16)
+        self.hedge = HedgePolicy.from_config("llm", config)
         self.max_token = max_token
         self.system_prompt = ""
-        self.set_system_prompt(prompt_path=Path(characters[character_name]["prompt_path"]))
+        self.backend: LLMBackend | None = None
+        self.model: str | None = None
+        self.set_character(character_name)
+
+    def set_character(self, character_name: str) -> None:
+        """キャラクターのプロンプトとLLMバックエンド(character.tomlのllm_backend / llm_model)を設定するメソッド"""
+        character = characters[character_name]
+        # バックエンドとプロンプトを先に解決し、途中で失敗しても現在の設定を壊さない
+        backend = get_backend(self.config, character.get("llm_backend", DEFAULT_BACKEND))
+        system_prompt = Path(character["prompt_path"]).read_text(encoding="utf-8").strip()
+        self.backend = backend
+        self.model = character.get("llm_model", backend.model)
+        self.system_prompt = system_prompt
 
     def set_system_prompt(self, prompt_path: Path | None = None, prompt: str | None = None) -> None:
         """システムプロンプトを設定するメソッド"""
@@ -43,20 +57,57 @@ class LLMModel:
         return self.system_prompt
 
     async def reply(self, history: list[Message]) -> str | None:
-        try:
-            messages = [{"role": "system", "content": self.system_prompt}] + [entry.model_dump() for entry in history]
-            response = await self.openai.chat.completions.create(
-                model=MODEL,
-                messages=messages,
-                max_tokens=self.max_token
-            )
-            return response.choices[0].message.content.strip()
-        
-        except Exception as e:
-            print(e)
-            logging.error(f"Error in LLM answer generation: {e}")
-            return None
+        # 同時実行数の上限を超えた場合はBackendBusyErrorを呼び出し元へ伝える
+        async with self.admission.acquire():
+            # タイムアウトは試行ごとにターンの残り時間から決め、期限を超えるリトライはしない(代わりにヘッジする)
+            # ヘッジの2本目はLLMの枠をもう1つ使うので、空きがなければヘッジしない
+            try:
+                messages = self._build_messages(history)
+                return await self.hedge.run(lambda: self.backend.complete(
+                    messages,
+                    model=self.model,
+                    max_tokens=self.max_token,
+                    timeout=stage_timeout("llm")
+                ), admission=self.admission)
+
+            except APITimeoutError:
+                raise DeadlineExceeded("llm")
+
+            except DeadlineExceeded:
+                # 試行前に期限が切れていた場合(stage_timeoutが送出する)も呼び出し元へ伝える
+                raise
+            
+            except Exception as e:
+                print(e)
+                logging.error(f"Error in LLM answer generation: {e}")
+                return None
         
+    async def reply_stream(self, history: list[Message]) -> AsyncIterator[str]:
+        """
+        応答をストリーミングで生成し、テキストの差分を順にyieldする
+        /speechは応答全文で感情分析してから合成するためreply()を使う。こちらは外部から使うAPIとして提供している
+        """
+        async with self.admission.acquire():
+            timeout = stage_timeout("llm")
+            try:
+                async for delta in self.backend.stream(
+                    self._build_messages(history),
+                    model=self.model,
+                    max_tokens=self.max_token,
+                    timeout=timeout
+                ):
+                    yield delta
+
+            except APITimeoutError:
+                raise DeadlineExceeded("llm")
+
+            except Exception as e:
+                logging.error(f"Error in LLM answer streaming: {e}")
+                raise
+
+    def _build_messages(self, history: list[Message]) -> list[dict]:
+        return [{"role": "system", "content": self.system_prompt}] + [entry.model_dump() for entry in history]
+
     async def is_conv_ongoing(self, input: str) -> bool:
         try:
             prompt = f"""
@@ -65,14 +116,13 @@ class LLMModel:
 
             会話の途中である場合は 0 を、そうでない場合は 1 を返してください。
             """
-            response = await self.openai.chat.completions.create(
-                model=MODEL,
-                messages=[
+            result = await self.backend.complete(
+                [
                     {"role": "system", "content": "あなたは会話の文脈を分析する専門家です。"},
                     {"role": "user", "content": prompt}
-                ]
+                ],
+                model=self.model
             )
-            result = response.choices[0].message.content.strip()
             print(result)
             is_mid_conversation = result.split("\n", 1)[0] == "0"
             reason = result.split("\n", 1)[1] if "\n" in result else ""
@@ -0,0 +1,120 @@
+import time
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, NOT_GIVEN
+from typing import AsyncIterator
+
+from deadline import LatencyTracker
+
+DEFAULT_BACKEND = "openai"
+DEFAULT_MODEL = "gpt-4o-mini"
+
+class LLMBackend:
+    """
+    OpenAI互換エンドポイント1つ分のクライアントと統計
+    同じエンドポイントを使うキャラクター間でコネクションプールを共有する
+    """
+    def __init__(self, name: str, base_url: str | None = None, api_key: str | None = None, model: str = DEFAULT_MODEL, stream_usage: bool = True, max_connections: int = 100):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.stream_usage = stream_usage  # stream_optionsに対応していないサーバーではFalseにする
+        self.client = AsyncOpenAI(
+            api_key=api_key or "EMPTY",  # ローカルサーバーはAPIキー不要な場合が多い
+            base_url=base_url,
+            http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)),
+        )
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = LatencyTracker()
+        self.first_token_latency = LatencyTracker()
+
+    def _client_for(self, timeout: float | None) -> AsyncOpenAI:
+        # 期限があるときはSDKのリトライで期限を超えないようにする
+        return self.client if timeout is None else self.client.with_options(timeout=timeout, max_retries=0)
+
+    def _record_usage(self, usage) -> None:
+        if usage:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+
+    async def complete(self, messages: list[dict], model: str | None = None, max_tokens: int | None = None, timeout: float | None = None) -> str:
+        start_time = time.perf_counter()
+        self.requests += 1
+        try:
+            response = await self._client_for(timeout).chat.completions.create(
+                model=model or self.model,
+                messages=messages,
+                max_tokens=max_tokens or NOT_GIVEN
+            )
+        except Exception:
+            self.errors += 1
+            raise
+
+        self.latency.record(time.perf_counter() - start_time)
+        self._record_usage(response.usage)
+        return response.choices[0].message.content.strip()
+
+    async def stream(self, messages: list[dict], model: str | None = None, max_tokens: int | None = None, timeout: float | None = None) -> AsyncIterator[str]:
+        """生成されたテキストの差分を順にyieldする"""
+        start_time = time.perf_counter()
+        self.requests += 1
+        try:
+            response = await self._client_for(timeout).chat.completions.create(
+                model=model or self.model,
+                messages=messages,
+                max_tokens=max_tokens or NOT_GIVEN,
+                stream=True,
+                stream_options={"include_usage": True} if self.stream_usage else NOT_GIVEN
+            )
+            try:
+                first_token = True
+                async for chunk in response:
+                    self._record_usage(chunk.usage)
+                    if chunk.choices and (delta := chunk.choices[0].delta.content):
+                        if first_token:
+                            self.first_token_latency.record(time.perf_counter() - start_time)
+                            first_token = False
+                        yield delta
+            finally:
+                await response.close()
+        except Exception:
+            self.errors += 1
+            raise
+
+        self.latency.record(time.perf_counter() - start_time)
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "model": self.model,
+            "requests": self.requests,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": self.latency.stats(),
+            "first_token_latency": self.first_token_latency.stats(),
+        }
+
+# バックエンド名 -> LLMBackend (プロセス内で共有)
+_backends: dict[str, LLMBackend] = {}
+
+def get_backend(config: dict, name: str = DEFAULT_BACKEND) -> LLMBackend:
+    """
+    config.tomlの[llm.backends.<name>]からバックエンドを取得(初回のみ生成)
+    "openai"は未設定でも[openai]のapi_keyを使う公式エンドポイントになる
+    """
+    if name not in _backends:
+        settings = dict(config.get("llm", {}).get("backends", {}).get(name, {}))
+        if name == DEFAULT_BACKEND:
+            settings.setdefault("api_key", config["openai"]["api_key"])
+            if not settings["api_key"]:
+                raise ValueError("OpenAI API key not found in environment variables")
+        elif "base_url" not in settings:
+            raise ValueError(f"LLM backend not configured: {name}")
+        _backends[name] = LLMBackend(name, **settings)
+    return _backends[name]
+
+def backend_stats() -> dict:
+    return {name: backend.stats() for name, backend in _backends.items()}
@@ -0,0 +1,41 @@
+import json
+import time
+from collections import defaultdict
+from pathlib import Path
+
+class SessionRecorder:
+    """
+    /speechのセッションを追記専用のJSON Linesログに記録する
+    1行1イベント: {"ts": UNIX時刻, "session": セッションID, "type": "open" | "message" | "character" | "close", ...}
+    キャラクター変更はサーバー全体に効くため、sessionはNoneで記録する
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8", buffering=1)  # 行バッファリングで途中終了しても残す
+
+    def record(self, event_type: str, session: str | None = None, **data) -> None:
+        event = {"ts": round(time.time(), 3), "session": session, "type": event_type, **data}
+        self._file.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+def load_recording(path: Path) -> tuple[dict[str, list[dict]], list[dict]]:
+    """
+    記録を読み込み、(セッションごとのイベント, キャラクター変更などの全体イベント)を返す
+    書き込み途中の壊れた行は読み飛ばす
+    """
+    sessions: dict[str, list[dict]] = defaultdict(list)
+    global_events: list[dict] = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("session") is None:
+                global_events.append(event)
+            else:
+                sessions[event["session"]].append(event)
+    return dict(sessions), global_events
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Literal
 
 # Schemes
 class Message(BaseModel):
@@ -11,5 +12,21 @@ class KaiwaResponse(BaseModel):
     audio_duration: float
     emotion: int
 
+class EmotionSegment(BaseModel):
+    text: str
+    emotion: int
+    offset: float = 0.0 # 音声ストリーム先頭からの開始位置(秒)
+    duration: float = 0.0 # 音声の長さ(秒)
+
 class CharacterChangeRequest(BaseModel):
-    character_name: str
\ No newline at end of file
+    character_name: str
+
+class AudioFormatRequest(BaseModel):
+    """クライアントが希望する音声フォーマット(未指定の項目はFish-Speechの出力のまま)"""
+    sample_rate: int | None = Field(default=None, ge=8000, le=48000)
+    channels: Literal[1, 2] | None = None
+    encoding: Literal["pcm16", "float32"] = "pcm16"
+    normalize: bool = False
+
+    def is_passthrough(self) -> bool:
+        return self.sample_rate is None and self.channels is None and self.encoding == "pcm16" and not self.normalize
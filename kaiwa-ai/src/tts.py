@@ -1,13 +1,25 @@
+import asyncio
 import logging
+from contextlib import AbstractAsyncContextManager, aclosing, nullcontext
+from functools import partial
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Callable, Iterator
 import requests
+from requests.adapters import HTTPAdapter
 import ormsgpack
 from pydantic import BaseModel
 import struct
 import io
+import socket
+import threading
 import time
 from urllib.parse import urljoin
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ReadTimeoutError
+
+from admission import AdmissionController
+from deadline import DeadlineExceeded, check_deadline, deadline_var, stage_timeout
 
 AMPLITUDE = 32768  # 16-bit PCMのための振幅スケーリング係数
 
@@ -75,9 +87,198 @@ def parse_wav_header(wav_data: bytes) -> tuple[int, bytes]:
                 # 他のチャンクをスキップ
                 wav_io.read(chunk_size)
 
+class WavFormat(BaseModel):
+    sample_rate: int
+    channels: int
+    bits_per_sample: int
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * self.channels * self.bits_per_sample // 8
+
+def parse_wav_stream_header(wav_data: bytes) -> tuple[WavFormat, int] | None:
+    """
+    ストリーミングWAVの先頭からフォーマットとヘッダー長を取得
+    ヘッダーがまだ揃っていない場合はNoneを返す
+    """
+    if len(wav_data) < 12:
+        return None
+    if wav_data[:4] != b'RIFF' or wav_data[8:12] != b'WAVE':
+        raise ValueError("Invalid WAV stream: RIFF/WAVE header not found")
+
+    wav_format = None
+    position = 12
+    while position + 8 <= len(wav_data):
+        chunk_id = wav_data[position:position + 4]
+        chunk_size = struct.unpack('<I', wav_data[position + 4:position + 8])[0]
+        position += 8
+
+        if chunk_id == b'data':
+            # ストリーミングではdataチャンクのサイズが確定していないため、ここでヘッダー終端とする
+            if wav_format is None:
+                raise ValueError("Invalid WAV stream: fmt chunk not found")
+            return wav_format, position
+
+        if position + chunk_size > len(wav_data):
+            return None
+
+        if chunk_id == b'fmt ':
+            _, channels, sample_rate = struct.unpack('<HHI', wav_data[position:position + 8])
+            bits_per_sample = struct.unpack('<H', wav_data[position + 14:position + 16])[0]
+            wav_format = WavFormat(sample_rate=sample_rate, channels=channels, bits_per_sample=bits_per_sample)
+
+        position += chunk_size
+
+    return None
+
+_END = object()
+
+def is_read_timeout(error: Exception) -> bool:
+    """
+    受信の途中で読み取りがタイムアウトしたか
+    iter_contentはReadTimeoutErrorをrequests.exceptions.ConnectionErrorに包んで送出するため、Timeoutでは捕まらない
+    """
+    return isinstance(error, requests.exceptions.ConnectionError) and bool(error.args) and isinstance(error.args[0], ReadTimeoutError)
+
+def shutdown_socket(sock: socket.socket) -> None:
+    """別スレッドで受信待ちになっているソケットを打ち切る"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # 既に切断されている
+
+class InterruptibleConnectionMixin:
+    """
+    接続したソケットをPrefetchStreamに登録するHTTP接続
+    レスポンスヘッダーを待っている間もcancel()でソケットを打ち切れるようにする
+    """
+    def __init__(self, *args, stream: "PrefetchStream", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream = stream
+
+    def connect(self) -> None:
+        super().connect()
+        self.stream.attach(self.sock)
+
+class InterruptibleHTTPConnection(InterruptibleConnectionMixin, HTTPConnection):
+    pass
+
+class InterruptibleHTTPSConnection(InterruptibleConnectionMixin, HTTPSConnection):
+    pass
+
+class InterruptibleHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = InterruptibleHTTPConnection
+
+class InterruptibleHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = InterruptibleHTTPSConnection
+
+class InterruptibleAdapter(HTTPAdapter):
+    """PrefetchStreamごとに作り、そのストリームに接続のソケットを登録するアダプター"""
+    def __init__(self, stream: "PrefetchStream"):
+        self.stream = stream
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        # 接続プールのキーに余計な引数を入れないよう、ストリームはプールのクラス側で渡す
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": partial(InterruptibleHTTPConnectionPool, stream=self.stream),
+            "https": partial(InterruptibleHTTPSConnectionPool, stream=self.stream),
+        }
+
+class PrefetchStream:
+    """
+    同期的なチャンクのイテレータを別スレッドで回し、上限付きのバッファに貯めて非同期に読み出す
+    バッファがbudgetバイトを超えると受信を止め(サーバーへは背圧がかかる)、cancel()で受信を打ち切る
+    attach()したソケットはcancel()でshutdownするので、接続中やヘッダー待ちを含めて受信待ちのスレッドもすぐに止まる
+    (close()は受信中のスレッドとロックを取り合ってブロックするため、shutdownだけ行い、受信側が例外で抜けて閉じる)
+    ターンの期限が設定されていれば、期限までに次のチャンクが届かない場合はDeadlineExceededにする
+    """
+    def __init__(self, iterator_factory: Callable[[], Iterator[bytes]], budget: int):
+        self.iterator_factory = iterator_factory
+        self.budget = budget
+        self.buffered = 0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._space = threading.Condition()
+        self._cancelled = False
+        self._sock: socket.socket | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Future | None = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        # to_threadはcontextvarsを引き継ぐので、ターンの期限もスレッド側で参照できる
+        self._task = asyncio.ensure_future(asyncio.to_thread(self._run))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def attach(self, sock: socket.socket) -> None:
+        """受信に使うソケットを登録する(既にキャンセルされていればすぐに打ち切る)"""
+        with self._space:
+            self._sock = sock
+            cancelled = self._cancelled
+        if cancelled:
+            shutdown_socket(sock)
+
+    def cancel(self) -> None:
+        with self._space:
+            self._cancelled = True
+            self._space.notify_all()
+            sock = self._sock
+        if sock is not None:
+            shutdown_socket(sock)
+
+    def _put(self, item) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            pass  # イベントループが既に閉じている
+
+    def _run(self) -> None:
+        try:
+            for chunk in self.iterator_factory():
+                with self._space:
+                    while not self._cancelled and self.buffered > 0 and self.buffered + len(chunk) > self.budget:
+                        self._space.wait()
+                    if self._cancelled:
+                        return
+                    self.buffered += len(chunk)
+                self._put(chunk)
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def __aiter__(self) -> "PrefetchStream":
+        return self
+
+    async def __anext__(self) -> bytes:
+        # 読み取りのタイムアウトはチャンク間の待ち時間にしか効かないので、ターンの残り時間でも打ち切る
+        deadline = deadline_var.get()
+        if deadline is None:
+            item = await self._queue.get()
+        else:
+            deadline.check("tts")
+            try:
+                item = await asyncio.wait_for(self._queue.get(), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("tts") from None
+        if item is _END:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        with self._space:
+            self.buffered -= len(item)
+            self._space.notify_all()
+        return item
+
 class FishSpeechTTS:
-    def __init__(self, base_url: str = "http://localhost:8080"):
+    def __init__(self, base_url: str = "http://localhost:8080", admission: AdmissionController | None = None, lookahead: int = 1, prefetch_budget: int = 4 * 1024 * 1024):
         self.base_url = base_url.rstrip('/')
+        self.admission = admission or AdmissionController("tts")
+        self.lookahead = lookahead  # 先読みして合成しておく文の数(0で無効)
+        self.prefetch_budget = prefetch_budget  # 1文あたりのバッファ上限(バイト)
         self.tts_url = f"{self.base_url}/v1/tts"
         self.health_url = f"{self.base_url}/v1/health"
         self.current_reference_id = None
@@ -105,12 +306,20 @@ class FishSpeechTTS:
         Returns:
             tuple[int, bytes]: (サンプルレート, 音声データ)
         """
+        async with self.admission.acquire():
+            return await asyncio.to_thread(self.synthesize, text)
+
+    def synthesize(self, text: str, reference_id: str | None = None) -> tuple[int, bytes]:
+        """
+        テキストから音声を同期的に生成(asyncio.to_threadでバックグラウンド実行できるようにするため)
+        reference_idを省略した場合は現在のリファレンスを使用
+        Returns:
+            tuple[int, bytes]: (サンプルレート, 音声データ)
+        """
         try:
-            if not self._is_server_available():
-                self._check_server_availability()  # 再確認を試みる
             data = {
                 "text": text,
-                "reference_id": self.current_reference_id,
+                "reference_id": reference_id or self.current_reference_id,
                 "streaming": False,
                 "format": "wav",
                 "normalize": True
@@ -119,7 +328,8 @@ class FishSpeechTTS:
             response = requests.post(
                 self.tts_url,
                 data=ormsgpack.packb(data, option=ormsgpack.OPT_SERIALIZE_PYDANTIC),
-                headers={"content-type": "application/msgpack"}
+                headers={"content-type": "application/msgpack"},
+                timeout=stage_timeout("tts")
             )
 
             if response.status_code != 200:
@@ -129,6 +339,9 @@ class FishSpeechTTS:
             sample_rate, audio_data = parse_wav_header(response.content)
             return sample_rate, audio_data
 
+        except requests.exceptions.Timeout:
+            raise DeadlineExceeded("tts")
+
         except Exception as e:
             logging.error(f"Error in speech generation: {e}")
             raise
@@ -138,6 +351,28 @@ class FishSpeechTTS:
         テキストから音声をストリーミングで生成
         Fish-Speechのストリーミング仕様に従って実装
         """
+        async with self.admission.acquire(), aclosing(self._stream_speak(text)) as stream:
+            async for chunk in stream:
+                yield chunk
+
+    async def _stream_speak(self, text: str) -> AsyncGenerator[bytes, None]:
+        stream = self._start_stream(text)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            stream.cancel()
+
+    def _start_stream(self, text: str) -> PrefetchStream:
+        stream = PrefetchStream(lambda: self._iter_stream(text, stream), self.prefetch_budget)
+        stream.start()
+        return stream
+
+    def _iter_stream(self, text: str, stream: PrefetchStream | None = None) -> Iterator[bytes]:
+        """
+        Fish-Speechのストリーミングレスポンスを同期的に受信する(PrefetchStreamのスレッドで実行)
+        streamを渡すと接続のソケットを登録し、キャンセル時に接続を打ち切れるようにする
+        """
         try:
             data = {
                 "text": text,
@@ -147,27 +382,110 @@ class FishSpeechTTS:
                 "normalize": True
             }
 
-            response = requests.post(
-                self.tts_url,
-                data=ormsgpack.packb(data, option=ormsgpack.OPT_SERIALIZE_PYDANTIC),
-                headers={"content-type": "application/msgpack"},
-                stream=True
-            )
+            with requests.Session() as session:
+                if stream is not None:
+                    # 接続した時点でソケットを登録し、レスポンスヘッダーを待っている間もキャンセルで打ち切れるようにする
+                    session.mount("http://", InterruptibleAdapter(stream))
+                    session.mount("https://", InterruptibleAdapter(stream))
 
-            if response.status_code != 200:
-                raise Exception(f"TTS streaming request failed: {response.text}")
+                response = session.post(
+                    self.tts_url,
+                    data=ormsgpack.packb(data, option=ormsgpack.OPT_SERIALIZE_PYDANTIC),
+                    headers={"content-type": "application/msgpack"},
+                    stream=True,
+                    timeout=stage_timeout("tts")  # 接続とチャンク間の待ち時間に適用される
+                )
+
+                # Fish-Speechのストリーミングレスポンスを処理
+                with response:
+                    if stream is not None and stream.cancelled:
+                        return  # ヘッダーを受け取った直後にキャンセルされた
+
+                    if response.status_code != 200:
+                        raise Exception(f"TTS streaming request failed: {response.text}")
 
-            # Fish-Speechのストリーミングレスポンスを処理
-            for chunk in response.iter_content(chunk_size=None):  # チャンクサイズはサーバー側で制御
-                if chunk:
-                    # サーバー側でAMPLITUDEによるスケーリングと16bit変換が行われているため
-                    # クライアント側での追加処理は不要
-                    yield chunk
+                    for chunk in response.iter_content(chunk_size=None):  # チャンクサイズはサーバー側で制御
+                        if chunk:
+                            # サーバー側でAMPLITUDEによるスケーリングと16bit変換が行われているため
+                            # クライアント側での追加処理は不要
+                            yield chunk
+
+        except requests.exceptions.Timeout:
+            raise DeadlineExceeded("tts")
 
         except Exception as e:
+            if stream is not None and stream.cancelled:
+                return  # cancel()で接続を打ち切ったことによる例外
+            if is_read_timeout(e):
+                raise DeadlineExceeded("tts")
             logging.error(f"Error in speech streaming: {e}")
             raise
 
+    def reserve(self) -> AbstractAsyncContextManager[None]:
+        """
+        応答1本分の合成枠を先に確保する
+        感情分析やメタデータの送信より前に確保しておけば、TTSが混雑しているときはクライアントへ何も送らずに拒否できる
+        """
+        return self.admission.acquire()
+
+    async def stream_speak_sentences(self, sentences: list[str], reserved: bool = False) -> AsyncGenerator[tuple[int, bytes, float], None]:
+        """
+        複数の文を順に合成し、1本のWAVストリームとして返す
+        2文目以降のWAVヘッダーは取り除くため、クライアントからは1つの音声に見える
+        reserve()で枠を確保済みの場合はreserved=Trueとし、ここでは枠を取らない
+        Yields:
+            tuple[int, bytes, float]: (文のインデックス, 音声チャンク, チャンクに含まれる音声の長さ(秒))
+        """
+        # 応答の途中で枠を失わないよう、全文の合成が終わるまで1枠を保持する
+        slot = nullcontext() if reserved else self.admission.acquire()
+        async with slot, aclosing(self._stream_speak_sentences(sentences)) as stream:
+            async for item in stream:
+                yield item
+
+    async def _stream_speak_sentences(self, sentences: list[str]) -> AsyncGenerator[tuple[int, bytes, float], None]:
+        # 文Nを送っている間に、後続の文をlookahead個まで先に合成してバッファしておく
+        # 先読みの分はTTSの枠を待たずに取れるときだけ追加で取り、混雑時は先読みせずに順に合成する
+        streams: list[PrefetchStream] = []
+        extra_slots = 0
+        try:
+            for index, sentence in enumerate(sentences):
+                check_deadline("tts")
+                if len(streams) == index:
+                    streams.append(self._start_stream(sentence))
+                while len(streams) <= min(index + self.lookahead, len(sentences) - 1) and self.admission.try_acquire():
+                    extra_slots += 1
+                    streams.append(self._start_stream(sentences[len(streams)]))
+
+                wav_format = None
+                pending = b""
+
+                async for chunk in streams[index]:
+                    if wav_format is None:
+                        pending += chunk
+                        header = parse_wav_stream_header(pending)
+                        if header is None:
+                            continue
+                        wav_format, header_length = header
+                        header_bytes, chunk = pending[:header_length], pending[header_length:]
+                        if index == 0:
+                            yield index, header_bytes, 0.0
+                        if not chunk:
+                            continue
+
+                    yield index, chunk, len(chunk) / wav_format.bytes_per_second
+
+                if len(streams) > index + 1:
+                    # 先読み済みの次の文は応答の枠で続けるので、追加で取った枠を1つ返す
+                    self.admission.release()
+                    extra_slots -= 1
+
+        finally:
+            # 中断された場合は先読み中の合成も止める
+            for stream in streams:
+                stream.cancel()
+            for _ in range(extra_slots):
+                self.admission.release()
+
     def update_model(self, reference_id: str):
         """リファレンスIDを更新"""
         self.current_reference_id = reference_id
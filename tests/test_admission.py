@@ -0,0 +1,101 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import asyncio
+import pytest
+from admission import AdmissionController, BackendBusyError
+from deadline import Deadline, DeadlineExceeded, deadline_var
+
+async def hold(controller: AdmissionController, session_id: str, order: list[str], release: asyncio.Event):
+    async with controller.acquire(session_id):
+        order.append(session_id)
+        await release.wait()
+
+# 空きが出たらセッション間でラウンドロビンに割り当てる
+def test_fair_queuing_between_sessions():
+    async def scenario():
+        controller = AdmissionController("tts", max_concurrency=1, max_queue_wait=1.0)
+        order: list[str] = []
+        release = asyncio.Event()
+        release.set()
+        blocker = asyncio.Event()
+
+        first = asyncio.create_task(hold(controller, "a", order, blocker))
+        await asyncio.sleep(0)
+        # セッションaが連続で3件、bが1件待つ
+        tasks = [asyncio.create_task(hold(controller, session, order, release)) for session in ["a", "a", "a", "b"]]
+        await asyncio.sleep(0)
+        assert controller.queued == 4
+        blocker.set()
+        await asyncio.gather(first, *tasks)
+        return order, controller
+
+    order, controller = asyncio.run(scenario())
+    assert order == ["a", "a", "b", "a", "a"]
+    assert controller.in_flight == 0 and controller.queued == 0
+    assert controller.stats()["admitted"] == 5
+
+# 待ち時間の上限を超えたらBackendBusyErrorで拒否する
+def test_reject_after_max_queue_wait():
+    async def scenario():
+        controller = AdmissionController("llm", max_concurrency=1, max_queue_wait=0.05)
+        blocker = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", [], blocker))
+        await asyncio.sleep(0)
+        with pytest.raises(BackendBusyError):
+            async with controller.acquire("b"):
+                pass
+        blocker.set()
+        await holder
+        return controller
+
+    controller = asyncio.run(scenario())
+    stats = controller.stats()
+    assert stats["rejected"] == 1
+    assert stats["queued"] == 0
+    assert stats["in_flight"] == 0
+
+# ターンの期限がmax_queue_waitより先に来る場合は期限までしか待たない
+def test_queue_wait_capped_by_deadline():
+    async def scenario():
+        controller = AdmissionController("tts", max_concurrency=1, max_queue_wait=5.0)
+        blocker = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", [], blocker))
+        await asyncio.sleep(0)
+        deadline_var.set(Deadline(0.05))
+        with pytest.raises(DeadlineExceeded) as e:
+            async with controller.acquire("b"):
+                pass
+        waited = deadline_var.get().elapsed()
+        blocker.set()
+        await holder
+        return e.value, waited
+
+    error, waited = asyncio.run(scenario())
+    assert error.stage == "tts"
+    assert waited < 1.0
+
+# 待ち行列が埋まっている場合は即座に拒否する
+def test_reject_when_queue_full():
+    async def scenario():
+        controller = AdmissionController("llm", max_concurrency=1, max_queue_size=0)
+        blocker = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", [], blocker))
+        await asyncio.sleep(0)
+        with pytest.raises(BackendBusyError):
+            async with controller.acquire("b"):
+                pass
+        blocker.set()
+        await holder
+
+    asyncio.run(scenario())
+
+def test_from_config():
+    config = {"admission": {"llm": {"max_concurrency": 2, "max_queue_wait": 1.5}}}
+    controller = AdmissionController.from_config("llm", config, max_concurrency=16)
+    assert controller.max_concurrency == 2
+    assert controller.max_queue_wait == 1.5
+    assert AdmissionController.from_config("tts", config, max_concurrency=4).max_concurrency == 4
@@ -0,0 +1,70 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import numpy as np
+from audio import AudioStreamProcessor, make_wav_stream_header
+from schemes import AudioFormatRequest
+from tts import WavFormat, parse_wav_stream_header
+
+def make_stream(seconds: float = 1.0, sample_rate: int = 44100, channels: int = 2) -> bytes:
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    tone = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype('<i2')
+    frames = np.repeat(tone[:, None], channels, axis=1)
+    header = make_wav_stream_header(WavFormat(sample_rate=sample_rate, channels=channels, bits_per_sample=16))
+    return header + frames.tobytes()
+
+def run(processor: AudioStreamProcessor, stream: bytes, chunk_size: int) -> bytes:
+    output = b"".join(processor.process(stream[i:i + chunk_size]) for i in range(0, len(stream), chunk_size))
+    return output + processor.flush()
+
+# 44.1kHzステレオを16kHzモノラルへ変換
+def test_resample_and_downmix():
+    stream = make_stream()
+    output = run(AudioStreamProcessor(AudioFormatRequest(sample_rate=16000, channels=1)), stream, 4096)
+
+    wav_format, header_length = parse_wav_stream_header(output)
+    assert wav_format == WavFormat(sample_rate=16000, channels=1, bits_per_sample=16)
+    samples = np.frombuffer(output[header_length:], dtype='<i2')
+    assert abs(len(samples) - 16000) <= 2
+    assert len(output) * 5 < len(stream)
+    # 440Hzの振幅が保たれていること
+    assert abs(np.abs(samples[1000:-1000]).max() / 32767 - 0.3) < 0.02
+
+# float32出力と正規化でも、チャンクの切れ目(奇数バイトを含む)でサンプル数が変わらないこと
+def test_float32_normalized_chunked():
+    stream = make_stream(seconds=0.5)
+    request = AudioFormatRequest(sample_rate=22050, channels=1, encoding="float32", normalize=True)
+    whole = run(AudioStreamProcessor(request), stream, len(stream))
+    chunked = run(AudioStreamProcessor(request), stream, 1001)
+
+    _, header_length = parse_wav_stream_header(whole)
+    a = np.frombuffer(whole[header_length:], dtype='<f4')
+    b = np.frombuffer(chunked[header_length:], dtype='<f4')
+    assert len(a) == len(b)
+    assert np.abs(b).max() <= 1.0
+
+# リサンプリング結果がチャンクの切れ目に依存しないこと
+def test_chunk_boundaries_resample_exact():
+    stream = make_stream(seconds=0.5)
+    request = AudioFormatRequest(sample_rate=16000)
+    whole = run(AudioStreamProcessor(request), stream, len(stream))
+    chunked = run(AudioStreamProcessor(request), stream, 777)
+    assert np.abs(np.frombuffer(whole, dtype='<i2').astype(int) - np.frombuffer(chunked, dtype='<i2')).max() <= 1
+
+# 正規化のゲインは無音から音声に切り替わるチャンクの境界でも跳ねない
+def test_normalize_gain_ramps_across_chunks():
+    processor = AudioStreamProcessor(AudioFormatRequest(encoding="float32", normalize=True))
+    header = make_wav_stream_header(WavFormat(sample_rate=44100, channels=1, bits_per_sample=16))
+    quiet = np.full(4410, 1000, dtype='<i2')
+    output = processor.process(header + quiet.tobytes())
+    output += processor.process(quiet.tobytes())
+
+    _, header_length = parse_wav_stream_header(output)
+    samples = np.frombuffer(output[header_length:], dtype='<f4')
+    steps = np.abs(np.diff(samples))
+    # 定数入力なので、隣り合うサンプルの差は小さな増分だけになる
+    assert steps.max() < 1e-3
+    assert samples[-1] > samples[0]
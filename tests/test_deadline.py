@@ -0,0 +1,101 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import asyncio
+import pytest
+from admission import AdmissionController
+from deadline import DEFAULT_STAGE_TIMEOUTS, Deadline, DeadlineExceeded, HedgePolicy, LatencyTracker, deadline_var, hedged, stage_timeout
+
+# 各ステージのタイムアウトは残り時間から決まる
+def test_stage_timeout_from_remaining_budget():
+    deadline = Deadline(10.0)
+    assert 5.0 < deadline.timeout("llm") <= 6.0
+    assert 9.0 < deadline.timeout("tts") <= 10.0
+
+# ターンの外ではステージごとの既定のタイムアウトを使う
+def test_stage_timeout_default_outside_turn():
+    assert deadline_var.get() is None
+    assert stage_timeout("tts") == DEFAULT_STAGE_TIMEOUTS["tts"]
+    assert stage_timeout("unknown") is None
+
+def test_expired_deadline():
+    deadline = Deadline(0.0)
+    with pytest.raises(DeadlineExceeded) as e:
+        deadline.timeout("tts")
+    assert e.value.stage == "tts"
+
+# 1本目が遅い場合は2本目の結果を使い、1本目はキャンセルする
+def test_hedged_uses_faster_attempt():
+    async def scenario():
+        attempts = []
+        cancelled = []
+
+        async def call():
+            attempt = len(attempts)
+            attempts.append(attempt)
+            try:
+                await asyncio.sleep(1.0 if attempt == 0 else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(attempt)
+                raise
+            return attempt
+
+        result = await hedged(call, hedge_after=0.02)
+        await asyncio.sleep(0)
+        return result, attempts, cancelled
+
+    result, attempts, cancelled = asyncio.run(scenario())
+    assert result == 1
+    assert attempts == [0, 1]
+    assert cancelled == [0]
+
+def test_hedged_not_triggered_when_fast():
+    async def scenario():
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            return "ok"
+
+        return await hedged(call, hedge_after=0.5), attempts
+
+    assert asyncio.run(scenario()) == ("ok", [1])
+
+# バックエンドの枠に空きがなければヘッジせず、空きがあれば2本目の分の枠を取って返す
+def test_hedged_respects_admission():
+    async def scenario(max_concurrency):
+        admission = AdmissionController("llm", max_concurrency=max_concurrency)
+        attempts = []
+
+        async def call():
+            attempts.append(admission.in_flight)
+            await asyncio.sleep(0.05 if len(attempts) == 1 else 0.01)
+            return len(attempts)
+
+        async with admission.acquire():
+            result = await hedged(call, hedge_after=0.01, admission=admission)
+        return result, attempts, admission.in_flight
+
+    assert asyncio.run(scenario(1)) == (1, [1], 0)
+    assert asyncio.run(scenario(2)) == (2, [1, 2], 0)
+
+# サンプルが揃うまではヘッジしない
+def test_hedge_policy_waits_for_samples():
+    policy = HedgePolicy(enabled=True, percentile=0.9, min_samples=10)
+    assert policy.hedge_after() is None
+    for i in range(10):
+        policy.latency.record(i / 10)
+    assert policy.hedge_after() == 0.9
+    assert HedgePolicy.from_config("llm", {}).hedge_after() is None
+
+def test_latency_tracker_stats():
+    tracker = LatencyTracker()
+    for i in range(100):
+        tracker.record(float(i))
+    stats = tracker.stats()
+    assert stats["count"] == 100
+    assert stats["p50"] == 50.0
+    assert stats["p99"] == 99.0
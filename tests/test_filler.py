@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import asyncio
+from admission import AdmissionController
+from filler import FillerAudioCache
+from tts import parse_wav_stream_header
+
+class FakeTTS:
+    def __init__(self):
+        self.requests = []
+        self.admission = AdmissionController("tts", max_concurrency=1)
+
+    def synthesize(self, text, reference_id=None):
+        self.requests.append((text, reference_id))
+        if text == "失敗":
+            raise Exception("TTS request failed")
+        return 44100, b"\x01\x00" * 100
+
+# キャラクターごとのreference_idでフィラーを合成してメモリに保持する
+def test_prepare_and_pick():
+    tts = FakeTTS()
+    cache = FillerAudioCache(tts)
+    characters = {
+        "marui": {"reference_id": "uzuki", "fillers": ["えーと", "失敗", "うんうん"]},
+        "rinu": {"reference_id": "rinu", "fillers": ["なるほど"]},
+    }
+    asyncio.run(cache.prepare(characters, priority="rinu"))
+
+    assert tts.requests[0] == ("なるほど", "rinu")
+    assert ("えーと", "uzuki") in tts.requests
+    assert [clip.text for clip in cache.clips["marui"]] == ["えーと", "うんうん"]
+
+    first = cache.pick("marui")
+    second = cache.pick("marui")
+    assert first.text != second.text
+    wav_format, header_length = parse_wav_stream_header(first.wav)
+    assert wav_format.sample_rate == 44100
+    assert len(first.wav) - header_length == 200
+
+# 準備できていないキャラクターではフィラーを流さない
+def test_pick_unprepared():
+    assert FillerAudioCache(FakeTTS()).pick("marui") is None
@@ -47,11 +47,22 @@ def test_websocket_connection():
         assert response["type"] == "metadata"
         assert "text" in response
         assert "emotion" in response
+        assert len(response["emotions"]) > 0
         
-        # 音声データの受信（バイナリデータ）
-        binary_data = websocket.receive_bytes()
-        assert len(binary_data) > 0
+        # 音声データ（バイナリデータ）と文ごとの感情を終了メッセージまで受信
+        audio_size = 0
+        while True:
+            message = websocket.receive()
+            if message.get("bytes") is not None:
+                audio_size += len(message["bytes"])
+                continue
+            data = json.loads(message["text"])
+            if data["type"] == "emotion":
+                assert "offset" in data
+                continue
+            break
+        assert audio_size > 0
         
         # 終了メッセージの受信
-        end_response = websocket.receive_json()
-        assert end_response["type"] == "end" 
\ No newline at end of file
+        assert data["type"] == "end"
+        assert len(data["timeline"]) == len(response["emotions"])
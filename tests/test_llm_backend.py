@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import llm_backend
+from llm_backend import LLMBackend, get_backend
+
+REPLY = ["こんにちは", "、元気", "ですか？"]
+USAGE = {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15}
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """/v1/chat/completionsだけを実装したOpenAI互換のスタンドインサーバー"""
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        self.server.requests.append(body)
+        base = {"id": "chatcmpl-test", "created": 0, "model": body["model"]}
+
+        if not body.get("stream"):
+            payload = json.dumps({**base, "object": "chat.completion", "usage": USAGE, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(REPLY)}}
+            ]}).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        chunks = [{"choices": [{"index": 0, "delta": {"content": text}}]} for text in REPLY]
+        chunks.append({"choices": [], "usage": USAGE})
+        for chunk in chunks:
+            self.wfile.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', **chunk})}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stand_in_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def clean_backends():
+    # プロセス内で共有するレジストリを他のテストに漏らさない
+    saved = dict(llm_backend._backends)
+    llm_backend._backends.clear()
+    yield
+    llm_backend._backends.clear()
+    llm_backend._backends.update(saved)
+
+def make_backend(server) -> LLMBackend:
+    return LLMBackend("local", base_url=f"http://127.0.0.1:{server.server_port}/v1", model="local-model")
+
+def test_complete(stand_in_server):
+    backend = make_backend(stand_in_server)
+    messages = [{"role": "user", "content": "こんにちは"}]
+    assert asyncio.run(backend.complete(messages, max_tokens=50, timeout=5.0)) == "".join(REPLY)
+
+    assert stand_in_server.requests[0]["model"] == "local-model"
+    assert stand_in_server.requests[0]["max_tokens"] == 50
+    stats = backend.stats()
+    assert stats["requests"] == 1
+    assert stats["completion_tokens"] == 3
+    assert stats["latency"]["count"] == 1
+
+def test_stream(stand_in_server):
+    backend = make_backend(stand_in_server)
+
+    async def collect():
+        return [delta async for delta in backend.stream([{"role": "user", "content": "こんにちは"}], model="other-model")]
+
+    assert asyncio.run(collect()) == REPLY
+    assert stand_in_server.requests[0]["model"] == "other-model"
+    stats = backend.stats()
+    assert stats["prompt_tokens"] == 12
+    assert stats["first_token_latency"]["count"] == 1
+    assert stats["errors"] == 0
+
+# 同じ名前のバックエンドは共有され、未設定のバックエンドはエラーになる
+def test_get_backend_shared(clean_backends):
+    config = {"openai": {"api_key": "sk-test"}, "llm": {"backends": {"shared": {"base_url": "http://127.0.0.1:1/v1"}}}}
+    assert get_backend(config, "shared") is get_backend(config, "shared")
+    with pytest.raises(ValueError):
+        get_backend(config, "missing")
+    assert set(llm_backend._backends) == {"shared"}
@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+from recorder import SessionRecorder, load_recording
+
+# セッションごとのイベントと全体イベントに分けて読み込めること
+def test_record_and_load(tmp_path):
+    path = tmp_path / "recordings" / "sessions.jsonl"
+    recorder = SessionRecorder(path)
+    recorder.record("open", "a")
+    recorder.record("message", "a", data={"text": "こんにちは"})
+    recorder.record("character", character_name="rinu")
+    recorder.record("close", "a")
+    recorder.close()
+
+    # 書き込み途中で終了した行は読み飛ばす
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"ts": 1, "sess')
+
+    sessions, global_events = load_recording(path)
+    assert [event["type"] for event in sessions["a"]] == ["open", "message", "close"]
+    assert sessions["a"][1]["data"] == {"text": "こんにちは"}
+    assert global_events[0]["character_name"] == "rinu"
+    assert "こんにちは" in path.read_text(encoding="utf-8")
+
+# 追記専用なので、再起動しても既存の記録は残る
+def test_append_only(tmp_path):
+    path = tmp_path / "sessions.jsonl"
+    for session in ["a", "b"]:
+        recorder = SessionRecorder(path)
+        recorder.record("open", session)
+        recorder.close()
+    sessions, _ = load_recording(path)
+    assert set(sessions) == {"a", "b"}
@@ -0,0 +1,118 @@
+import sys
+from pathlib import Path
+
+# 再生ツールのディレクトリをPythonパスに追加(ソースコードのディレクトリはreplay.pyが追加する)
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "scripts"))
+
+import asyncio
+import json
+import time
+from websockets.asyncio.server import serve
+from replay import ReplayStats, compare, replay_session, run
+
+class StandInSpeechServer:
+    """
+    /speechの応答の流れだけを真似るスタンドイン
+    テキストの内容で応答を切り替える: "busy"ならbusyだけ、"slow"なら少し待ってから、それ以外はmetadata→音声→end
+    """
+    def __init__(self):
+        self.received: list[tuple[float, dict]] = []
+
+    async def handler(self, websocket):
+        async for message in websocket:
+            data = json.loads(message)
+            self.received.append((time.perf_counter(), data))
+            if "audio_format" in data:
+                await websocket.send(json.dumps({"type": "audio_format"}))
+            if "text" not in data:
+                continue
+            if data["text"] == "busy":
+                await websocket.send(json.dumps({"type": "busy", "backend": "tts"}))
+                continue
+            if data["text"] == "slow":
+                await asyncio.sleep(0.1)
+            await websocket.send(json.dumps({"type": "metadata", "text": data["text"]}))
+            await websocket.send(b"\x00\x00" * 100)
+            await websocket.send(json.dumps({"type": "end", "timeline": []}))
+
+def message(ts: float, data: dict) -> dict:
+    return {"ts": ts, "session": "a", "type": "message", "data": data}
+
+async def replay_against_stand_in(events: list[dict], speed: float) -> tuple[StandInSpeechServer, ReplayStats]:
+    stand_in = StandInSpeechServer()
+    stats = ReplayStats()
+    async with serve(stand_in.handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        await replay_session(f"ws://127.0.0.1:{port}", events, events[0]["ts"], speed, time.perf_counter(), stats)
+    return stand_in, stats
+
+# 応答を送信順のターンに対応づけ、終端メッセージの種類ごとに集計する
+def test_replay_session_pairs_responses_with_turns():
+    events = [
+        {"ts": 0.0, "session": "a", "type": "open"},
+        message(0.0, {"audio_format": {"sample_rate": 16000}}),  # ターンではない
+        message(0.0, {"text": "slow"}),
+        message(0.0, {"text": "busy"}),
+        message(0.0, {"text": "こんにちは"}),
+        {"ts": 0.0, "session": "a", "type": "close"},
+    ]
+    stand_in, stats = asyncio.run(replay_against_stand_in(events, speed=1.0))
+    report = stats.report()
+
+    assert [data for _, data in stand_in.received][1:] == [{"text": "slow"}, {"text": "busy"}, {"text": "こんにちは"}]
+    assert report["turns"] == 3
+    assert report["outcomes"] == {"end": 2, "busy": 1, "timeout": 0, "error": 0}
+    assert report["first_response"]["count"] == 3
+    assert report["first_audio"]["count"] == 2
+    assert report["turn_end"]["count"] == 2
+    # 応答は送信順に返るので、遅いターンの後ろのターンにもその待ち時間が含まれる
+    assert report["turn_end"]["p50"] >= 0.1
+
+# 記録上の間隔をspeed倍速に縮めて送信する
+def test_replay_session_speed_scaling():
+    events = [message(100.0, {"text": "一つ目"}), message(101.0, {"text": "二つ目"})]
+    stand_in, stats = asyncio.run(replay_against_stand_in(events, speed=5.0))
+
+    (first, _), (second, _) = stand_in.received
+    assert 0.15 < second - first < 0.5
+    assert stats.report()["outcomes"]["end"] == 2
+
+# 記録ファイルから全セッションを再生してレポートを返す
+def test_run_recording(tmp_path):
+    path = tmp_path / "sessions.jsonl"
+    lines = [
+        message(10.0, {"text": "こんにちは"}),
+        {**message(10.0, {"text": "busy"}), "session": "b"},
+    ]
+    path.write_text("\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n", encoding="utf-8")
+
+    async def scenario():
+        stand_in = StandInSpeechServer()
+        async with serve(stand_in.handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            return await run(path, f"ws://127.0.0.1:{port}", speed=1.0)
+
+    report = asyncio.run(scenario())
+    assert report["sessions"] == 2
+    assert report["turns"] == 2
+    assert report["outcomes"]["end"] == 1
+    assert report["outcomes"]["busy"] == 1
+
+def make_report(turn_end_p50: float | None, first_audio_p50: float | None) -> dict:
+    empty = {"count": 0, "p50": None, "p95": None, "p99": None}
+    return {
+        "first_response": empty,
+        "first_audio": {**empty, "p50": first_audio_p50},
+        "turn_end": {**empty, "p50": turn_end_p50},
+        "outcomes": {"end": 1, "busy": 0, "timeout": 0, "error": 0},
+    }
+
+# パーセンタイルがNoneの指標は飛ばし、基準が0なら差分は"-"にする
+def test_compare_handles_missing_and_zero_baselines():
+    table = compare(make_report(2.0, 0.0), make_report(1.5, 0.3)).splitlines()
+    rows = {line[:24].strip(): line[24:].split() for line in table[1:]}
+
+    assert [name for name in rows if " p" in name] == ["first_audio p50", "turn_end p50"]
+    assert rows["first_audio p50"] == ["0.000", "0.300", "-"]
+    assert rows["turn_end p50"] == ["2.000", "1.500", "-25.0%"]
+    assert rows["end"] == ["1", "1"]
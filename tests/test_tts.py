@@ -0,0 +1,272 @@
+import sys
+from pathlib import Path
+
+# ソースコードのディレクトリをPythonパスに追加
+sys.path.append(str(Path(__file__).parent.parent / "kaiwa-ai" / "src"))
+
+import asyncio
+import io
+import threading
+import time
+import wave
+from collections import defaultdict
+from contextlib import aclosing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from admission import AdmissionController
+from deadline import Deadline, DeadlineExceeded, deadline_var
+from tts import FishSpeechTTS, parse_wav_stream_header
+
+def make_stream_header(sample_rate: int = 44100, channels: int = 1) -> bytes:
+    # Fish-Speechのストリーミングと同様に、フレームなしのWAVヘッダーを作る
+    with io.BytesIO() as wav_io:
+        with wave.open(wav_io, "wb") as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+        return wav_io.getvalue()
+
+# ストリーミングWAVヘッダーの解析
+def test_parse_wav_stream_header():
+    header = make_stream_header()
+    wav_format, header_length = parse_wav_stream_header(header + b"\x00\x01" * 10)
+    assert header_length == len(header)
+    assert wav_format.sample_rate == 44100
+    assert wav_format.bytes_per_second == 44100 * 2
+
+# ヘッダーが途中までしか届いていない場合
+def test_parse_wav_stream_header_incomplete():
+    header = make_stream_header()
+    assert parse_wav_stream_header(header[:20]) is None
+
+class FakeFishSpeechTTS(FishSpeechTTS):
+    """Fish-Speechサーバーの代わりに、文ごとに決まったチャンク列を返す"""
+    def __init__(self, chunks_for, **kwargs):
+        self.chunks_for = chunks_for
+        self.events: list[tuple[str, str]] = []  # ("start" | "finish", 文)
+        self.started: defaultdict[str, threading.Event] = defaultdict(threading.Event)
+        self.stopped: defaultdict[str, threading.Event] = defaultdict(threading.Event)
+        super().__init__(**kwargs)
+
+    def _check_server_availability(self, *args, **kwargs) -> None:
+        pass
+
+    def _iter_stream(self, text, stream=None):
+        self.events.append(("start", text))
+        self.started[text].set()
+        try:
+            yield from self.chunks_for(text)
+            self.events.append(("finish", text))
+        finally:
+            self.stopped[text].set()
+
+def collect(tts: FakeFishSpeechTTS, sentences: list[str], limit: int | None = None) -> list:
+    async def run():
+        results = []
+        async with aclosing(tts.stream_speak_sentences(sentences)) as stream:
+            async for item in stream:
+                results.append(item)
+                if limit and len(results) >= limit:
+                    break
+        # キャンセルされたスレッドが止まるのを待つ
+        for sentence in list(tts.started):
+            assert await asyncio.to_thread(tts.stopped[sentence].wait, 1.0)
+        return results
+    return asyncio.run(run())
+
+# 複数文の合成結果が1本のWAVストリームになること
+def test_stream_speak_sentences_single_header():
+    header = make_stream_header(sample_rate=8000)
+
+    def chunks_for(text):
+        # ヘッダーが分割されて届くケースも含める
+        yield header[:10]
+        yield header[10:] + b"\x00\x00" * 4000
+        yield b"\x00\x00" * 4000
+
+    results = collect(FakeFishSpeechTTS(chunks_for), ["一文目。", "二文目。"])
+    audio = b"".join(chunk for _, chunk, _ in results)
+    assert audio.count(b"RIFF") == 1
+    assert sum(duration for index, _, duration in results if index == 0) == 1.0
+    assert sum(duration for index, _, duration in results if index == 1) == 1.0
+
+# 文Nを読み出している間に文N+1の合成が始まっていること
+def test_lookahead_prefetches_next_sentence():
+    header = make_stream_header(sample_rate=8000)
+    sentences = ["一文目。", "二文目。", "三文目。"]
+
+    def chunks_for(text):
+        if text == sentences[0]:
+            # 2文目の先読みが始まるまで1文目を返さない(先読みされなければ失敗する)
+            assert tts.started[sentences[1]].wait(1.0)
+        yield header
+        for _ in range(5):
+            yield b"\x00\x00" * 100
+
+    tts = FakeFishSpeechTTS(chunks_for, lookahead=1)
+    results = collect(tts, sentences)
+    assert [index for index, _, _ in results].count(2) == 5
+    # 3文目は1文目を読み終えてから先読みされる
+    assert tts.events.index(("start", sentences[2])) > tts.events.index(("finish", sentences[0]))
+    assert tts.admission.in_flight == 0
+
+# TTSの枠に空きがなければ先読みせず、1文ずつ順に合成する
+def test_lookahead_skipped_without_capacity():
+    header = make_stream_header(sample_rate=8000)
+
+    def chunks_for(text):
+        yield header + b"\x00\x00" * 100
+
+    tts = FakeFishSpeechTTS(chunks_for, lookahead=1, admission=AdmissionController("tts", max_concurrency=1))
+    sentences = ["一文目。", "二文目。"]
+    collect(tts, sentences)
+    assert tts.events == [("start", sentences[0]), ("finish", sentences[0]), ("start", sentences[1]), ("finish", sentences[1])]
+    assert tts.admission.in_flight == 0
+
+# 途中で打ち切ると先読み中の合成も止まり、バッファは上限を超えない
+def test_lookahead_cancelled_on_interrupt():
+    header = make_stream_header(sample_rate=8000)
+
+    def chunks_for(text):
+        yield header
+        for _ in range(100):
+            yield b"\x00\x00" * 100
+
+    tts = FakeFishSpeechTTS(chunks_for, lookahead=1, prefetch_budget=1000)
+    results = collect(tts, ["一文目。", "二文目。"], limit=3)
+    assert len(results) == 3
+    assert sorted(tts.started) == sorted(["一文目。", "二文目。"])
+    assert not any(event == "finish" for event, _ in tts.events)
+
+# reserve()で確保した枠の中ではreserved=Trueで追加の枠を取らずに合成できる
+def test_stream_speak_sentences_with_reserved_slot():
+    header = make_stream_header(sample_rate=8000)
+
+    def chunks_for(text):
+        yield header + b"\x00\x00" * 100
+
+    tts = FakeFishSpeechTTS(chunks_for, lookahead=0, admission=AdmissionController("tts", max_concurrency=1, max_queue_wait=0.1))
+
+    async def run():
+        async with tts.reserve():
+            assert tts.admission.in_flight == 1
+            return [item async for item in tts.stream_speak_sentences(["一文目。"], reserved=True)]
+
+    results = asyncio.run(run())
+    assert sum(duration for _, _, duration in results) == 100 / 8000
+    assert tts.admission.in_flight == 0
+
+class StandInFishSpeechTTS(FishSpeechTTS):
+    """ヘルスチェックだけ省いた本物のクライアント"""
+    def _check_server_availability(self, *args, **kwargs) -> None:
+        pass
+
+class StalledHandler(BaseHTTPRequestHandler):
+    """WAVヘッダーだけ返して止まるFish-Speech互換のスタンドイン"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["content-length"]))
+        self.send_response(200)
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        header = make_stream_header()
+        self.wfile.write(f"{len(header):x}\r\n".encode() + header + b"\r\n")
+        self.wfile.flush()
+        self.server.release.wait(10.0)
+
+    def log_message(self, *args):
+        pass
+
+class DelayedHeadersHandler(BaseHTTPRequestHandler):
+    """リクエストを受け取ったまま、レスポンスヘッダーを返さずに止まるスタンドイン"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["content-length"]))
+        self.server.release.wait(10.0)
+
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def serve_stand_in(handler: type[BaseHTTPRequestHandler]):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.release = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield StandInFishSpeechTTS(base_url=f"http://127.0.0.1:{server.server_port}")
+    finally:
+        server.release.set()
+        server.shutdown()
+
+@pytest.fixture
+def stalled_tts():
+    with serve_stand_in(StalledHandler) as tts:
+        yield tts
+
+@pytest.fixture
+def delayed_headers_tts():
+    with serve_stand_in(DelayedHeadersHandler) as tts:
+        yield tts
+
+# cancel()はブロック中の受信を打ち切り、スレッドをすぐに止める
+def test_cancel_interrupts_blocked_response(stalled_tts):
+    async def run():
+        stream = stalled_tts._start_stream("テスト")
+        assert (await stream.__anext__()).startswith(b"RIFF")
+        started = time.perf_counter()
+        stream.cancel()
+        await asyncio.wait_for(stream._task, 1.0)
+        return time.perf_counter() - started
+
+    # cancel()がイベントループを止めず、受信中のスレッドもすぐに抜ける
+    assert asyncio.run(run()) < 1.0
+
+# レスポンスヘッダーを待っている間にcancel()しても、スレッドをすぐに止める
+def test_cancel_interrupts_waiting_for_headers(delayed_headers_tts):
+    async def run():
+        stream = delayed_headers_tts._start_stream("テスト")
+        await asyncio.sleep(0.2)  # 接続してヘッダー待ちになるまで待つ
+        started = time.perf_counter()
+        stream.cancel()
+        await asyncio.wait_for(stream._task, 1.0)
+        return time.perf_counter() - started
+
+    assert asyncio.run(run()) < 1.0
+
+# 受信の途中で読み取りがタイムアウトした場合もDeadlineExceededになる
+def test_read_timeout_mid_stream_is_deadline_exceeded(stalled_tts):
+    token = deadline_var.set(Deadline(0.3))
+    try:
+        with pytest.raises(DeadlineExceeded) as e:
+            list(stalled_tts._iter_stream("テスト"))
+    finally:
+        deadline_var.reset(token)
+    assert e.value.stage == "tts"
+
+# チャンクが少しずつ届き続けても、ターンの期限で打ち切る
+def test_deadline_enforced_while_streaming():
+    header = make_stream_header(sample_rate=8000)
+    release = threading.Event()
+
+    def chunks_for(text):
+        yield header
+        for _ in range(200):  # 期限が効かなければ2秒ほどで終わり、DeadlineExceededにならずに失敗する
+            if release.wait(0.01):
+                return
+            yield b"\x00\x00" * 10
+
+    tts = FakeFishSpeechTTS(chunks_for, lookahead=0)
+
+    async def run():
+        deadline_var.set(Deadline(0.2))
+        with pytest.raises(DeadlineExceeded):
+            async for _ in tts.stream_speak_sentences(["一文目。"]):
+                pass
+        return deadline_var.get().elapsed()
+
+    try:
+        assert asyncio.run(run()) < 1.0
+    finally:
+        release.set()